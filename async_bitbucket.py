@@ -0,0 +1,519 @@
+"""Asynchronous Bitbucket proxy on aiohttp.
+
+Serves the same routes, arguments and responses as the proxy resources in
+bitbucket.py (users, projects, repositories and project permissions), but every
+upstream call is awaited on one shared client session per worker, so a single
+process can keep thousands of upstream requests in flight. The read cache and
+the batch endpoints are only available in the WSGI app.
+
+Run it with ``python async_bitbucket.py`` or under gunicorn with
+``APP_MODULE=async_bitbucket:create_app WORKER_CLASS=aiohttp.GunicornWebWorker``.
+"""
+import asyncio
+import json
+import os
+import time
+
+from aiohttp import BasicAuth, ClientError, ClientSession, ClientTimeout, DummyCookieJar, TCPConnector, web
+
+import metrics
+import ratelimit
+import upstream
+
+CONNECTION_LIMIT = int(os.environ.get('ASYNC_CONNECTION_LIMIT', '1000'))
+CONNECTION_LIMIT_PER_HOST = int(os.environ.get('ASYNC_CONNECTION_LIMIT_PER_HOST', '100'))
+# Methods that are safe to repeat after a 429 or 5xx answer
+IDEMPOTENT = ('GET', 'HEAD', 'PUT', 'DELETE')
+MISSING = 'Missing required parameter in the JSON body or the post body or the query string'
+
+routes = web.RouteTableDef()
+_swagger = None
+
+
+class UpstreamResponse:
+    """Status and body of an upstream answer, read before the connection is released"""
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+
+async def fetch(request, method, url, **kwargs):
+    """Send one upstream request; identical GETs in flight share one call"""
+    if method != 'GET' or not upstream.COALESCE:
+        return await send(request.app['session'], method, url, **kwargs)
+    flights = request.app['flights']
+    key = upstream.request_key(url, kwargs.get('params'), kwargs.get('headers'), kwargs.get('auth'))
+    flight = flights.get(key)
+    if flight is None:
+        flight = flights[key] = asyncio.ensure_future(send(request.app['session'], method, url, **kwargs))
+        flight.add_done_callback(lambda _: flights.pop(key, None))
+    else:
+        metrics.UPSTREAM_COALESCED.labels(upstream.base_url(url)).inc()
+    # A caller going away must not cancel the call the others wait for
+    return await asyncio.shield(flight)
+
+
+async def send(session, method, url, **kwargs):
+    """Send one upstream request on the shared session.
+
+    Calls are admitted by per host and credential limiters like
+    ``upstream.request``, with the higher async concurrency bounds; 429s are
+    retried after Retry-After and 5xx answers to idempotent calls with backoff.
+    """
+    host = upstream.base_url(url)
+    limiter = ratelimit.get_limiter(host, upstream.credential_id(kwargs.get('headers'), kwargs.get('auth')),
+                                    asynchronous=True)
+    attempt = 0
+    while True:
+        await limiter.acquire_async()
+        started = time.perf_counter()
+        try:
+            with metrics.upstream_call(host, method) as call:
+                async with session.request(method, url, **kwargs) as response:
+                    call.status = response.status
+                    body = await response.read()
+                    retry_after = response.headers.get('Retry-After')
+        except BaseException:
+            limiter.release()
+            raise
+        limiter.release(response.status, time.perf_counter() - started, retry_after)
+        if attempt >= upstream.MAX_RETRIES:
+            return UpstreamResponse(response.status, body)
+        if response.status != ratelimit.THROTTLED:
+            if response.status not in upstream.RETRY_STATUSES or method not in IDEMPOTENT:
+                return UpstreamResponse(response.status, body)
+            await asyncio.sleep(upstream.BACKOFF_FACTOR * (2 ** attempt))
+        attempt += 1
+
+
+async def iter_pages(request, url, params=None, **kwargs):
+    """Yield every page of a paged Bitbucket Server collection"""
+    params = dict(params or {})
+    while True:
+        response = await fetch(request, 'GET', url, params=params, **kwargs)
+        if response.status_code != 200:
+            raise upstream.UpstreamError(response.status_code)
+        page = response.json()
+        yield page
+        if page.get('isLastPage', True) or page.get('nextPageStart') is None:
+            return
+        params['start'] = page['nextPageStart']
+
+
+async def arguments(request):
+    """Collect the arguments bitbucket.py's request parsers read.
+
+    Values come from the query string, the form or, like reqparse, a JSON
+    object body. Returns ``(args, error_response)``.
+    """
+    args = dict(request.query)
+    if request.can_read_body:
+        if request.content_type == 'application/json':
+            try:
+                body = await request.json()
+            except ValueError:
+                body = None
+            if isinstance(body, dict):
+                args = {**body, **args}
+        else:
+            args = {**(await request.post()), **args}
+    if not args.get('BITBUCKET_URL'):
+        return args, web.json_response({'errors': {'BITBUCKET_URL': MISSING},
+                                        'message': 'Input payload validation failed'}, status=400)
+    for name, convert in (('limit', int), ('start', int), ('max_workers', int), ('deadline', float)):
+        if args.get(name) not in (None, ''):
+            try:
+                args[name] = convert(args[name])
+                if name == 'max_workers' and args[name] <= 0:
+                    raise ValueError(name)
+            except (TypeError, ValueError):
+                return args, web.json_response({'errors': {name: f'Invalid value: {args[name]}'},
+                                                'message': 'Input payload validation failed'}, status=400)
+        else:
+            args[name] = None
+    args['all_pages'] = str(args.get('all_pages', '')).lower() in ('true', '1', 'yes', 'on')
+    args['format'] = args.get('format') or 'json'
+    return args, None
+
+
+def page_params(args):
+    return {key: args[key] for key in ('limit', 'start') if args.get(key) is not None}
+
+
+def bearer_headers(args, **extra):
+    return {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {args.get("BITBUCKET_TOKEN")}',
+        **extra
+    }
+
+
+def basic_auth(args):
+    if args.get('BITBUCKET_USERNAME') is None:
+        return None
+    return BasicAuth(args['BITBUCKET_USERNAME'], args.get('BITBUCKET_PASSWORD') or '')
+
+
+def with_auth(headers, auth):
+    """aiohttp refuses an Authorization header together with ``auth``; basic auth wins, as in requests"""
+    if auth is not None:
+        headers = {name: value for name, value in headers.items() if name != 'Authorization'}
+    return {'headers': headers, 'auth': auth}
+
+
+def error(message, status=500):
+    return web.json_response({'error': message}, status=status)
+
+
+def json_result(response, expected=200):
+    if response.status_code != expected:
+        return error(f'Request failed with status code: {response.status_code}')
+    try:
+        return web.json_response(response.json(), status=expected)
+    except json.JSONDecodeError as e:
+        return error(f'Error decoding JSON: {str(e)}')
+
+
+async def stream(request, batches, fmt, envelope=True):
+    """Async counterpart of bitbucket.stream_response"""
+    response = web.StreamResponse()
+    response.content_type = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+    await response.prepare(request)
+    size = 0
+    failure = None
+    if fmt == 'json':
+        await response.write(b'{"values": [' if envelope else b'[')
+    try:
+        async for batch in batches:
+            if not batch:
+                continue
+            if fmt == 'ndjson':
+                chunk = ''.join(json.dumps(item) + '\n' for item in batch)
+            else:
+                chunk = (',' if size else '') + ','.join(json.dumps(item) for item in batch)
+            await response.write(chunk.encode())
+            size += len(batch)
+    except (upstream.UpstreamError, ClientError, asyncio.TimeoutError, ValueError) as e:
+        failure = str(e)
+    if fmt == 'ndjson':
+        tail = json.dumps({'error': failure}) + '\n' if failure else ''
+    elif envelope:
+        summary = {'size': size, 'isLastPage': failure is None}
+        if failure:
+            summary['error'] = failure
+        tail = '], ' + json.dumps(summary)[1:]
+    elif failure:
+        tail = (',' if size else '') + json.dumps({'error': failure}) + ']'
+    else:
+        tail = ']'
+    await response.write(tail.encode())
+    await response.write_eof()
+    return response
+
+
+async def paged(request, args, url, headers):
+    """One upstream page, or every page streamed when all_pages is set"""
+    params = page_params(args)
+    try:
+        if not args['all_pages']:
+            return json_result(await fetch(request, 'GET', url, headers=headers, params=params))
+        pages = iter_pages(request, url, params=params, headers=headers)
+        first_page = await pages.__anext__()
+    except upstream.UpstreamError as e:
+        return error(str(e))
+    except (ClientError, asyncio.TimeoutError) as e:
+        return error(f'Request failed: {str(e)}')
+
+    async def values():
+        yield first_page.get('values', [])
+        async for page in pages:
+            yield page.get('values', [])
+
+    return await stream(request, values(), args['format'])
+
+
+async def gather_bounded(func, items, max_workers, deadline):
+    """Async counterpart of upstream.fan_out: ``(result, error)`` pairs in input order"""
+    semaphore = asyncio.Semaphore(upstream.fanout_workers(max_workers))
+
+    async def bounded(item):
+        async with semaphore:
+            return await func(item)
+
+    tasks = [asyncio.ensure_future(bounded(item)) for item in items]
+    if not tasks:
+        return []
+    deadline = upstream.FANOUT_DEADLINE if deadline is None else deadline
+    await asyncio.wait(tasks, timeout=deadline or None)
+    results = []
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+            results.append((None, TimeoutError('Deadline exceeded')))
+        elif task.exception() is not None:
+            results.append((None, task.exception()))
+        else:
+            results.append((task.result(), None))
+    return results
+
+
+@routes.get('/Bitbucket/users')
+async def list_users(request):
+    """List all Bitbucket users"""
+    args, invalid = await arguments(request)
+    if invalid:
+        return invalid
+    return await paged(request, args, f'{args["BITBUCKET_URL"]}/users', bearer_headers(args))
+
+
+@routes.get('/Bitbucket/projects')
+async def list_projects(request):
+    """List all Bitbucket projects with their repositories"""
+    args, invalid = await arguments(request)
+    if invalid:
+        return invalid
+    BITBUCKET_URL = args['BITBUCKET_URL']
+    headers = bearer_headers(args)
+
+    async def fetch_repositories(project):
+        url = f'{BITBUCKET_URL}/projects/{project["key"]}/repos'
+        if args['all_pages']:
+            return [value async for page in iter_pages(request, url, headers=headers)
+                    for value in page.get('values', [])]
+        response = await fetch(request, 'GET', url, headers=headers)
+        if response.status_code != 200:
+            raise upstream.UpstreamError(response.status_code)
+        return response.json()['values']
+
+    async def with_repositories(projects):
+        results = await gather_bounded(fetch_repositories, projects, args['max_workers'], args['deadline'])
+        projects_and_repos = []
+        for project, (repositories, failure) in zip(projects, results):
+            project_info = {
+                'project_name': project['name'],
+                'repositories': repositories or []
+            }
+            if failure is not None:
+                project_info['error'] = str(failure)
+            projects_and_repos.append(project_info)
+        return projects_and_repos
+
+    pages = iter_pages(request, f'{BITBUCKET_URL}/projects', params=page_params(args), headers=headers)
+    try:
+        first_page = await pages.__anext__()
+    except upstream.UpstreamError as e:
+        return error(str(e))
+    except (ClientError, asyncio.TimeoutError) as e:
+        return error(f'Request failed: {str(e)}')
+    if not args['all_pages']:
+        return web.json_response(await with_repositories(first_page['values']))
+
+    async def batches():
+        yield await with_repositories(first_page['values'])
+        async for page in pages:
+            yield await with_repositories(page['values'])
+
+    return await stream(request, batches(), args['format'], envelope=False)
+
+
+@routes.post('/Bitbucket/projects')
+async def create_project(request):
+    """Create a new Bitbucket project"""
+    args, invalid = await arguments(request)
+    if invalid:
+        return invalid
+    data = await request.json()
+    payload = {
+        'key': data['key'],
+        'name': data['name'],
+        'description': data.get('description')
+    }
+    headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+    try:
+        response = await fetch(request, 'POST', f'{args["BITBUCKET_URL"]}/projects', json=payload,
+                               **with_auth(headers, basic_auth(args)))
+    except (ClientError, asyncio.TimeoutError) as e:
+        return error(f'Request failed: {str(e)}')
+    return json_result(response, expected=201)
+
+
+@routes.get('/Bitbucket/project/{project_key}')
+async def get_project(request):
+    """Get a specific Bitbucket project by project key"""
+    args, invalid = await arguments(request)
+    if invalid:
+        return invalid
+    project_key = request.match_info['project_key']
+    response = await fetch(request, 'GET', f'{args["BITBUCKET_URL"]}/projects/{project_key}',
+                           headers=bearer_headers(args))
+    return json_result(response)
+
+
+@routes.delete('/Bitbucket/project/{project_key}')
+async def delete_project(request):
+    """Delete a Bitbucket project by project key"""
+    args, invalid = await arguments(request)
+    if invalid:
+        return invalid
+    project_key = request.match_info['project_key']
+    headers = bearer_headers(args, Accept='application/json')
+    try:
+        response = await fetch(request, 'DELETE', f'{args["BITBUCKET_URL"]}/projects/{project_key}',
+                               **with_auth(headers, basic_auth(args)))
+    except (ClientError, asyncio.TimeoutError) as e:
+        return error(f'Request failed: {str(e)}')
+    if response.status_code == 204:
+        return web.json_response({'message': 'Project deleted successfully'}, status=204)
+    if response.status_code == 404:
+        return error(f'Project with key {project_key} not found', status=404)
+    return error(f'Failed to delete project with status code: {response.status_code}')
+
+
+@routes.put('/Bitbucket/project/{project_key}')
+async def update_project(request):
+    """Update a Bitbucket project by project key"""
+    args, invalid = await arguments(request)
+    if invalid:
+        return invalid
+    project_key = request.match_info['project_key']
+    data = await request.json()
+    project_data = {
+        'key': project_key,
+        'name': data.get('name'),
+        'description': data.get('description')
+    }
+    headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+    try:
+        response = await fetch(request, 'PUT', f'{args["BITBUCKET_URL"]}/projects/{project_key}',
+                               json=project_data, **with_auth(headers, basic_auth(args)))
+    except (ClientError, asyncio.TimeoutError) as e:
+        return error(f'Request failed: {str(e)}')
+    if response.status_code != 200:
+        return error(f'Failed to update project with status code: {response.status_code}')
+    return json_result(response)
+
+
+@routes.get('/Bitbucket/project/{project_key}/repos')
+async def list_project_repos(request):
+    """List repositories of a specific Bitbucket project by project key"""
+    args, invalid = await arguments(request)
+    if invalid:
+        return invalid
+    project_key = request.match_info['project_key']
+    return await paged(request, args, f'{args["BITBUCKET_URL"]}/projects/{project_key}/repos',
+                       bearer_headers(args))
+
+
+@routes.post('/Bitbucket/project/{project_key}/repos')
+async def create_repo(request):
+    """Create a Bitbucket repository in a specific project by project key"""
+    args, invalid = await arguments(request)
+    if invalid:
+        return invalid
+    project_key = request.match_info['project_key']
+    data = await request.json()
+    repo_data = {
+        'name': data['name'],
+        'public': data.get('public'),
+        'description': data.get('description')
+    }
+    headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+    response = await fetch(request, 'POST', f'{args["BITBUCKET_URL"]}/projects/{project_key}/repos',
+                           json=repo_data, **with_auth(headers, basic_auth(args)))
+    return json_result(response, expected=201)
+
+
+@routes.delete('/Bitbucket/project/{project_key}/repos/{repositorySlug}')
+async def delete_repo(request):
+    args, invalid = await arguments(request)
+    if invalid:
+        return invalid
+    project_key = request.match_info['project_key']
+    slug = request.match_info['repositorySlug']
+    headers = bearer_headers(args, Accept='application/json')
+    response = await fetch(request, 'DELETE', f'{args["BITBUCKET_URL"]}/projects/{project_key}/repos/{slug}',
+                           **with_auth(headers, basic_auth(args)))
+    if response.status_code in (202, 204):
+        return web.json_response({'message': 'Repository deleted successfully'}, status=204)
+    if response.status_code == 404:
+        return web.json_response({'message': 'Repository does not exist'}, status=404)
+    return error(f'Failed to delete the repository with status code: {response.status_code}')
+
+
+@routes.get('/Bitbucket/projects/{project_key}/permissions/users')
+async def list_project_users(request):
+    """List users of a specific Bitbucket project by project key"""
+    args, invalid = await arguments(request)
+    if invalid:
+        return invalid
+    project_key = request.match_info['project_key']
+    return await paged(request, args, f'{args["BITBUCKET_URL"]}/projects/{project_key}/permissions/users',
+                       bearer_headers(args))
+
+
+@routes.get('/swagger.json')
+async def swagger(request):
+    """The Swagger document of bitbucket.py, limited to the routes served here"""
+    global _swagger
+    if _swagger is None:
+        import bitbucket
+
+        with bitbucket.app.test_request_context():
+            schema = dict(bitbucket.api.__schema__)
+        served = {info.path for info in routes if isinstance(info, web.RouteDef)}
+        schema['paths'] = {path: spec for path, spec in schema['paths'].items() if path in served}
+        _swagger = schema
+    return web.json_response(_swagger)
+
+
+@routes.get('/metrics')
+async def metrics_view(request):
+    response = metrics.metrics_view()
+    return web.Response(body=response.get_data(), headers={'Content-Type': response.mimetype})
+
+
+@web.middleware
+async def record_metrics(request, handler):
+    """aiohttp counterpart of the request hooks of metrics.init_app"""
+    resource = request.match_info.route.resource
+    endpoint = resource.canonical if resource is not None else 'unmatched'
+    in_flight = metrics.REQUESTS_IN_FLIGHT.labels(endpoint)
+    in_flight.inc()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        in_flight.dec()
+        metrics.REQUEST_SECONDS.labels(endpoint, request.method).observe(time.perf_counter() - started)
+        metrics.REQUESTS.labels(endpoint, request.method, str(status)).inc()
+
+
+async def _close_session(app):
+    await app['session'].close()
+
+
+async def create_app():
+    """aiohttp app factory; the client session lives as long as the app"""
+    app = web.Application(middlewares=[record_metrics])
+    app['flights'] = {}
+    app['session'] = ClientSession(
+        connector=TCPConnector(limit=CONNECTION_LIMIT, limit_per_host=CONNECTION_LIMIT_PER_HOST),
+        timeout=ClientTimeout(sock_connect=upstream.CONNECT_TIMEOUT, sock_read=upstream.READ_TIMEOUT),
+        cookie_jar=DummyCookieJar())
+    app.on_cleanup.append(_close_session)
+    app.add_routes(routes)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host='0.0.0.0', port=int(os.environ.get('PORT', '5050')))
@@ -0,0 +1,113 @@
+"""Permissions audit across every project of a Bitbucket Server instance."""
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+import upstream
+
+# Seconds the permissions of a project are reused before they are fetched again
+TTL = float(os.environ.get('AUDIT_TTL', '300'))
+MAX_SNAPSHOTS = int(os.environ.get('AUDIT_MAX_SNAPSHOTS', '32'))
+PAGE_SIZE = 1000
+PERMISSIONS = ('PROJECT_READ', 'PROJECT_WRITE', 'PROJECT_ADMIN')
+
+
+class _ProjectPermissions:
+    __slots__ = ('fetched', 'users', 'groups')
+
+    def __init__(self, users, groups):
+        self.fetched = time.monotonic()
+        self.users = users
+        self.groups = groups
+
+
+class PermissionAudit:
+    """Collects user and group permissions of every project and indexes them by name.
+
+    The permissions of each project are kept per Bitbucket URL and credential,
+    so a repeated audit only fetches projects that are new or older than
+    ``ttl``; projects that no longer exist are dropped.
+    """
+
+    def __init__(self, ttl=TTL, max_snapshots=MAX_SNAPSHOTS):
+        self.ttl = ttl
+        self.max_snapshots = max_snapshots
+        self._snapshots = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _snapshot(self, key):
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            if snapshot is None:
+                snapshot = self._snapshots[key] = {}
+            self._snapshots.move_to_end(key)
+            while len(self._snapshots) > self.max_snapshots:
+                self._snapshots.popitem(last=False)
+            return snapshot
+
+    @staticmethod
+    def _fetch(bitbucket_url, headers, project_key):
+        url = f'{bitbucket_url}/projects/{project_key}/permissions'
+        params = {'limit': PAGE_SIZE}
+        users = {value['user']['name']: value['permission']
+                 for value in upstream.iter_values(f'{url}/users', params=params, headers=headers)}
+        groups = {value['group']['name']: value['permission']
+                  for value in upstream.iter_values(f'{url}/groups', params=params, headers=headers)}
+        return _ProjectPermissions(users, groups)
+
+    def run(self, bitbucket_url, headers, user=None, group=None, permission=None, refresh=False,
+            max_workers=None, deadline=None):
+        """Return the audit report; raises ``UpstreamError`` if projects cannot be listed"""
+        snapshot = self._snapshot((bitbucket_url, upstream.credential_id(headers)))
+        projects = [project['key'] for project in
+                    upstream.iter_values(f'{bitbucket_url}/projects', params={'limit': PAGE_SIZE}, headers=headers)]
+        now = time.monotonic()
+        with self._lock:
+            for key in set(snapshot) - set(projects):
+                del snapshot[key]
+            stale = [key for key in projects
+                     if refresh or key not in snapshot or now - snapshot[key].fetched >= self.ttl]
+
+        results = upstream.fan_out(partial(self._fetch, bitbucket_url, headers), stale,
+                                   max_workers=max_workers, deadline=deadline)
+        errors = {}
+        with self._lock:
+            for key, (permissions, error) in zip(stale, results):
+                if error is not None:
+                    # The previous permissions, if any, stay in the report
+                    errors[key] = str(error)
+                else:
+                    snapshot[key] = permissions
+            entries = {key: snapshot[key] for key in projects if key in snapshot}
+
+        # Filtering by a user leaves out the groups and the other way round
+        return {
+            'users': index(entries, 'users', user, permission) if group is None or user is not None else {},
+            'groups': index(entries, 'groups', group, permission) if user is None or group is not None else {},
+            'summary': {
+                'projects': len(projects),
+                'fetched': len(stale) - len(errors),
+                'reused': len(projects) - len(stale),
+                'failed': len(errors),
+            },
+            'errors': errors,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+
+def index(entries, kind, name=None, permission=None):
+    """Invert project permissions into ``{name: {project_key: permission}}``"""
+    inverted = {}
+    for project_key, permissions in entries.items():
+        for holder, level in getattr(permissions, kind).items():
+            if (name is None or holder == name) and (permission is None or level == permission):
+                inverted.setdefault(holder, {})[project_key] = level
+    return inverted
+
+
+audits = PermissionAudit()
@@ -0,0 +1,305 @@
+"""Stand-in for the Bitbucket Server and Cloud REST APIs used by the proxy and the migration.
+
+Bitbucket Server is served under ``/rest/api/1.0`` (the plain paths work as
+well) and Bitbucket Cloud under ``/cloud/2.0``. Collections are paged like the
+real APIs, every answer can be delayed and a request rate limit answers the
+excess with 429 and Retry-After. State is kept in memory.
+
+    python -m benchmarks.mock_bitbucket --port 8990 --latency 0.02 --rate-limit 200
+"""
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+SERVER_PREFIX = '/rest/api/1.0'
+CLOUD_PREFIX = '/cloud/2.0'
+PERMISSIONS = ('PROJECT_READ', 'PROJECT_WRITE', 'PROJECT_ADMIN')
+
+
+class State:
+    """Projects, repositories and users of both instances"""
+
+    def __init__(self, projects=50, repositories=5, users=200):
+        self.lock = threading.Lock()
+        self.users = [{'name': f'user{i}', 'displayName': f'User {i}', 'slug': f'user{i}'} for i in range(users)]
+        self.projects = {}
+        self.repositories = {}
+        for i in range(projects):
+            key = f'PRJ{i}'
+            self.projects[key] = {'key': key, 'name': f'Project {i}', 'description': ''}
+            # Slugs are unique across projects, as Cloud repositories share one workspace
+            slugs = [f'{key.lower()}-repo-{j}' for j in range(repositories)]
+            self.repositories[key] = {slug: {'name': slug, 'slug': slug, 'public': False} for slug in slugs}
+        self.cloud_projects = {}
+        self.cloud_repositories = {}
+
+    def user_permissions(self, key):
+        index = int(re.sub(r'\D', '', key) or 0)
+        return [{'user': self.users[(index + n) % len(self.users)], 'permission': PERMISSIONS[n % 3]}
+                for n in range(min(5, len(self.users)))]
+
+    @staticmethod
+    def group_permissions(key):
+        return [{'group': {'name': 'developers'}, 'permission': 'PROJECT_WRITE'},
+                {'group': {'name': f'{key.lower()}-admins'}, 'permission': 'PROJECT_ADMIN'}]
+
+
+class RateLimit:
+    """Token bucket shared by all clients; ``rate`` 0 admits everything"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def admit(self):
+        if self.rate <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'MockBitbucket'
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def send(self, status, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        etag = None
+        if status == 200 and self.command == 'GET':
+            etag = '"' + hashlib.md5(data).hexdigest() + '"'
+            if self.headers.get('If-None-Match') == etag:
+                status, data = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if etag:
+            self.send_header('ETag', etag)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else b''
+        try:
+            return json.loads(data) if data else {}
+        except ValueError:
+            return {}
+
+    def server_page(self, values, query):
+        start = int(query.get('start', ['0'])[0])
+        limit = min(int(query.get('limit', [str(self.server.page_limit)])[0]), self.server.max_page_limit)
+        page = values[start:start + limit]
+        body = {'values': page, 'size': len(page), 'start': start, 'limit': limit,
+                'isLastPage': start + limit >= len(values)}
+        if not body['isLastPage']:
+            body['nextPageStart'] = start + limit
+        return body
+
+    def cloud_page(self, values, query, path):
+        number = int(query.get('page', ['1'])[0])
+        pagelen = min(int(query.get('pagelen', ['10'])[0]), 100)
+        page = values[(number - 1) * pagelen:number * pagelen]
+        body = {'values': page, 'page': number, 'pagelen': pagelen, 'size': len(values)}
+        if number * pagelen < len(values):
+            host = self.headers.get('Host')
+            body['next'] = f'http://{host}{path}?page={number + 1}&pagelen={pagelen}'
+        return body
+
+    def handle_request(self):
+        # The body is always consumed so the keep-alive connection stays usable
+        self.data = self.body()
+        self.server.count()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if not self.server.rate_limit.admit():
+            self.server.count(throttled=True)
+            return self.send(429, {'errors': [{'message': 'Rate limit exceeded'}]}, {'Retry-After': '1'})
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        path = url.path.rstrip('/')
+        if path.startswith(CLOUD_PREFIX):
+            status, body = self.cloud(path[len(CLOUD_PREFIX):], query, url.path)
+        else:
+            if path.startswith(SERVER_PREFIX):
+                path = path[len(SERVER_PREFIX):]
+            status, body = self.bitbucket_server(path, query)
+        self.send(status, body)
+
+    def bitbucket_server(self, path, query):
+        """Return the status and body answering a Bitbucket Server call"""
+        state = self.state
+        method = self.command
+        parts = path.strip('/').split('/')
+        with state.lock:
+            if parts == ['users'] and method == 'GET':
+                return (200, self.server_page(state.users, query))
+            if parts == ['projects']:
+                if method == 'GET':
+                    return (200, self.server_page(list(state.projects.values()), query))
+                if method == 'POST':
+                    data = self.data
+                    if data.get('key') in state.projects:
+                        return (409, {'errors': [{'message': 'Project key already exists'}]})
+                    state.projects[data['key']] = {'key': data['key'], 'name': data.get('name'),
+                                                   'description': data.get('description') or ''}
+                    state.repositories[data['key']] = {}
+                    return (201, state.projects[data['key']])
+            if len(parts) < 2 or parts[0] != 'projects' or parts[1] not in state.projects:
+                return (404, {'errors': [{'message': 'Not found'}]})
+            key = parts[1]
+            repositories = state.repositories[key]
+            if len(parts) == 2:
+                if method == 'GET':
+                    return (200, state.projects[key])
+                if method == 'PUT':
+                    state.projects[key].update({name: value for name, value in self.data.items()
+                                                if name in ('name', 'description') and value is not None})
+                    return (200, state.projects[key])
+                if method == 'DELETE':
+                    del state.projects[key], state.repositories[key]
+                    return (204, None)
+            if parts[2:] == ['permissions', 'users'] and method == 'GET':
+                return (200, self.server_page(state.user_permissions(key), query))
+            if parts[2:] == ['permissions', 'groups'] and method == 'GET':
+                return (200, self.server_page(state.group_permissions(key), query))
+            if parts[2:] == ['repos']:
+                if method == 'GET':
+                    return (200, self.server_page(list(repositories.values()), query))
+                if method == 'POST':
+                    data = self.data
+                    slug = re.sub(r'[^a-z0-9_-]+', '-', str(data.get('name', '')).lower())
+                    if slug in repositories:
+                        return (409, {'errors': [{'message': 'Repository already exists'}]})
+                    repositories[slug] = {'name': data.get('name'), 'slug': slug, 'public': bool(data.get('public')),
+                                          'description': data.get('description') or ''}
+                    return (201, repositories[slug])
+            if len(parts) >= 4 and parts[2] == 'repos':
+                if parts[3] not in repositories:
+                    return (404, {'errors': [{'message': 'Repository does not exist'}]})
+                if len(parts) == 4 and method == 'DELETE':
+                    del repositories[parts[3]]
+                    return (202, None)
+                if parts[4:] == ['sizes'] and method == 'GET':
+                    return (200, {'repository': 64 * 1024, 'attachments': 0})
+        return (404, {'errors': [{'message': 'Not found'}]})
+
+    def cloud(self, path, query, full_path):
+        """Return the status and body answering a Bitbucket Cloud call"""
+        state = self.state
+        method = self.command
+        parts = path.strip('/').split('/')
+        with state.lock:
+            if len(parts) == 3 and parts[0] == 'workspaces' and parts[2] == 'projects':
+                if method == 'GET':
+                    return (200, self.cloud_page(list(state.cloud_projects.values()), query, full_path))
+                if method == 'POST':
+                    data = self.data
+                    if data.get('key') in state.cloud_projects:
+                        return (400, {'error': {'message': 'Project with this key already exists'}})
+                    state.cloud_projects[data['key']] = {'key': data['key'], 'name': data.get('name')}
+                    return (201, state.cloud_projects[data['key']])
+            if len(parts) == 2 and parts[0] == 'repositories' and method == 'GET':
+                return (200, self.cloud_page(list(state.cloud_repositories.values()), query, full_path))
+            if len(parts) == 3 and parts[0] == 'repositories':
+                slug = parts[2]
+                data = self.data
+                repository = {'slug': slug, 'project': data.get('project'), 'is_private': data.get('is_private'),
+                              'description': data.get('description', '')}
+                if method == 'POST':
+                    if slug in state.cloud_repositories:
+                        return (400, {'error': {'message': 'Repository with this Slug already exists'}})
+                    state.cloud_repositories[slug] = repository
+                    return (201, repository)
+                if method == 'PUT':
+                    created = slug not in state.cloud_repositories
+                    state.cloud_repositories[slug] = repository
+                    return (201 if created else 200, repository)
+        return (404, {'error': {'message': 'Not found'}})
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = handle_request
+
+
+class MockBitbucket(ThreadingHTTPServer):
+    """Threaded mock server; ``start`` serves it from a background thread"""
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, rate_limit=0.0, page_limit=25,
+                 max_page_limit=1000, state=None):
+        super().__init__((host, port), Handler)
+        self.state = state or State()
+        self.latency = latency
+        self.rate_limit = RateLimit(rate_limit)
+        self.page_limit = page_limit
+        self.max_page_limit = max_page_limit
+        self.requests = 0
+        self.throttled = 0
+        self._counter_lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count(self, throttled=False):
+        with self._counter_lock:
+            if throttled:
+                self.throttled += 1
+            else:
+                self.requests += 1
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='mock-bitbucket', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8990)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every answer')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='requests per second before 429s, 0 for none')
+    parser.add_argument('--page-limit', type=int, default=25, help='default Bitbucket Server page size')
+    parser.add_argument('--projects', type=int, default=50)
+    parser.add_argument('--repositories', type=int, default=5, help='repositories per project')
+    parser.add_argument('--users', type=int, default=200)
+    args = parser.parse_args()
+    server = MockBitbucket(args.host, args.port, latency=args.latency, rate_limit=args.rate_limit,
+                           page_limit=args.page_limit,
+                           state=State(args.projects, args.repositories, args.users))
+    print(f'Bitbucket Server at {server.url}{SERVER_PREFIX}, Cloud at {server.url}{CLOUD_PREFIX}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+"""Throughput, latency and memory benchmarks against the mock Bitbucket.
+
+Scenarios:
+
+- ``list_fanout``: ``GET /Bitbucket/projects``, one repository call per project, cache off
+- ``cached_reads``: ``GET /Bitbucket/project/<key>/repos`` over a few projects, cache on
+- ``bulk_create``: ``POST /Bitbucket/projects/batch`` and ``/repos/batch``
+- ``migration``: ``Migration.run`` into local bare git repositories
+
+The proxy is served in this process by a threaded werkzeug server unless
+``--target`` points at a running deployment; the mock runs in a background
+thread. Peak RSS covers this process, so with ``--target`` only the clients.
+``--output`` writes the results as JSON and ``--baseline`` compares
+them with an earlier file, exiting with status 1 on a regression.
+
+    python -m benchmarks.run --latency 0.02 --output bench.json
+    python -m benchmarks.run --baseline bench.json --tolerance 0.2
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.mock_bitbucket import SERVER_PREFIX, MockBitbucket, State
+
+SCENARIOS = ('list_fanout', 'cached_reads', 'bulk_create', 'migration')
+BATCH_SIZE = 20
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of ``values``"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def report(name, latencies, errors, elapsed, **extra):
+    return {
+        'scenario': name,
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'peak_rss_mb': peak_rss_mb(),
+        **extra,
+    }
+
+
+def drive(name, call, total, concurrency):
+    """Run ``call(session, index)`` ``total`` times from ``concurrency`` client threads.
+
+    ``call`` returns the HTTP response; anything but 2xx counts as an error.
+    """
+    local = threading.local()
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(index):
+        nonlocal errors
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            ok = call(session, index).ok
+        except requests.exceptions.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            errors += not ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(one, range(total)))
+    return report(name, latencies, errors, time.perf_counter() - started)
+
+
+def serve_proxy():
+    """Serve bitbucket.app on a free port from a background thread"""
+    from werkzeug.serving import make_server
+
+    import bitbucket
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # one access log line per request otherwise
+    server = make_server('127.0.0.1', 0, bitbucket.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='proxy', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def set_cache_ttls(ttls):
+    """Replace the read cache TTLs of an in-process proxy and empty it; returns the previous TTLs"""
+    cache = sys.modules.get('cache')
+    if cache is None:
+        return None
+    previous = dict(cache.TTL)
+    cache.TTL.update(ttls)
+    cache.responses.clear()
+    return previous
+
+
+def list_fanout(proxy, mock, args):
+    previous = set_cache_ttls({'projects': 0, 'repos': 0})
+    try:
+        return drive('list_fanout', lambda session, index: session.get(
+            f'{proxy}/Bitbucket/projects', params={'BITBUCKET_URL': mock, 'BITBUCKET_TOKEN': 'token'}),
+            args.requests, args.concurrency)
+    finally:
+        if previous is not None:
+            set_cache_ttls(previous)
+
+
+def cached_reads(proxy, mock, args):
+    keys = [f'PRJ{i}' for i in range(min(10, args.projects))]
+    return drive('cached_reads', lambda session, index: session.get(
+        f'{proxy}/Bitbucket/project/{keys[index % len(keys)]}/repos',
+        params={'BITBUCKET_URL': mock, 'BITBUCKET_TOKEN': 'token'}),
+        args.requests, args.concurrency)
+
+
+def bulk_create(proxy, mock, args):
+    params = {'BITBUCKET_URL': mock, 'BITBUCKET_USERNAME': 'admin', 'BITBUCKET_PASSWORD': 'admin'}
+    run_id = f'{int(time.time() * 1000) % 100000:05d}'
+
+    def create(session, index):
+        key = f'B{run_id}{index:05d}'
+        projects = [{'key': f'{key}{n:02d}', 'name': f'Bench {key}{n:02d}'} for n in range(BATCH_SIZE)]
+        response = session.post(f'{proxy}/Bitbucket/projects/batch', params=params, json=projects)
+        if not response.ok:
+            return response
+        repositories = [{'project_key': project['key'], 'name': f'{project["key"].lower()}-repo'}
+                        for project in projects]
+        return session.post(f'{proxy}/Bitbucket/repos/batch', params=params, json=repositories)
+
+    result = drive('bulk_create', create, max(1, args.requests // BATCH_SIZE), args.concurrency)
+    result['items_per_second'] = round(result['requests_per_second'] * BATCH_SIZE * 2, 1)
+    return result
+
+
+def git(*args, cwd=None):
+    subprocess.run(['git', *args], cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def migration(proxy, mock, args):
+    """Migrate every repository of a dedicated mock instance between local bare repositories"""
+    from migration import Migration
+
+    root = tempfile.mkdtemp(prefix='bitbucket-bench-')
+    state = State(projects=args.migration_projects, repositories=args.migration_repositories, users=1)
+    server = MockBitbucket(latency=args.latency, state=state).start()
+    try:
+        seed = os.path.join(root, 'seed')
+        git('init', '-q', seed)
+        for n in range(args.commits):
+            with open(os.path.join(seed, 'file.txt'), 'a') as f:
+                f.write(f'line {n}\n' * 100)
+            git('add', 'file.txt', cwd=seed)
+            git('-c', 'user.name=bench', '-c', 'user.email=bench@example.com',
+                'commit', '-q', '-m', f'commit {n}', cwd=seed)
+        for key, repositories in state.repositories.items():
+            for slug in repositories:
+                git('clone', '-q', '--bare', seed, os.path.join(root, 'source', key, f'{slug}.git'))
+                git('init', '-q', '--bare', os.path.join(root, 'cloud', f'{slug}.git'))
+
+        class LocalMigration(Migration):
+            def clone_url(self, project, repository):
+                return os.path.join(root, 'source', project['key'], f'{repository["slug"]}.git')
+
+            def cloud_remote_url(self, repository):
+                return os.path.join(root, 'cloud', f'{repository["slug"]}.git')
+
+        job = LocalMigration(server.url, 'token', f'{server.url}/cloud/2.0', 'bench', 'bench', 'bench',
+                             git_workers=args.git_workers, api_workers=args.concurrency,
+                             workdir=os.path.join(root, 'work'))
+        started = time.perf_counter()
+        results = job.run()
+        elapsed = time.perf_counter() - started
+        failed = sum(1 for result in results if result['status'] == 'failed')
+        return report('migration', [result.get('duration') or 0.0 for result in results], failed, elapsed,
+                      upstream_requests=server.requests, upstream_throttled=server.throttled)
+    finally:
+        server.stop()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def regressions(results, baseline, tolerance):
+    """Describe every scenario slower than the baseline by more than ``tolerance``"""
+    previous = {result['scenario']: result for result in baseline}
+    found = []
+    for result in results:
+        before = previous.get(result['scenario'])
+        if before is None:
+            continue
+        if result['requests_per_second'] < before['requests_per_second'] * (1 - tolerance):
+            found.append(f"{result['scenario']}: {result['requests_per_second']} req/s, "
+                         f"baseline {before['requests_per_second']}")
+        if result['p99_ms'] > before['p99_ms'] * (1 + tolerance):
+            found.append(f"{result['scenario']}: p99 {result['p99_ms']} ms, baseline {before['p99_ms']}")
+        if result['errors'] > before['errors']:
+            found.append(f"{result['scenario']}: {result['errors']} errors, baseline {before['errors']}")
+    return found
+
+
+def print_table(results):
+    columns = ('scenario', 'requests', 'errors', 'requests_per_second', 'p50_ms', 'p99_ms', 'peak_rss_mb')
+    print(' '.join(f'{column:>20}' for column in columns))
+    for result in results:
+        print(' '.join(f'{result[column]!s:>20}' for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Bitbucket proxy and migration against a mock')
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS), help=f"any of {', '.join(SCENARIOS)}")
+    parser.add_argument('--target', help='URL of a running proxy to benchmark instead of an in-process one')
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds the mock waits before answering')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='mock requests per second before 429s')
+    parser.add_argument('--page-limit', type=int, default=25, help='default page size of the mock')
+    parser.add_argument('--projects', type=int, default=50)
+    parser.add_argument('--repositories', type=int, default=5, help='repositories per project')
+    parser.add_argument('--migration-projects', type=int, default=4)
+    parser.add_argument('--migration-repositories', type=int, default=5, help='repositories per migrated project')
+    parser.add_argument('--commits', type=int, default=20, help='commits in every migrated repository')
+    parser.add_argument('--git-workers', type=int, default=4)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+    unknown = sorted(set(args.scenarios) - set(SCENARIOS))
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    mock = MockBitbucket(latency=args.latency, rate_limit=args.rate_limit, page_limit=args.page_limit,
+                         state=State(args.projects, args.repositories)).start()
+    proxy_server = None
+    if args.target:
+        proxy = args.target.rstrip('/')
+    else:
+        proxy_server, proxy = serve_proxy()
+    results = []
+    try:
+        for name in args.scenarios:
+            before = mock.requests, mock.throttled
+            result = globals()[name](proxy, mock.url + SERVER_PREFIX, args)
+            result.setdefault('upstream_requests', mock.requests - before[0])
+            result.setdefault('upstream_throttled', mock.throttled - before[1])
+            results.append(result)
+            print(f"{name}: {result['requests_per_second']} req/s, p50 {result['p50_ms']} ms, "
+                  f"p99 {result['p99_ms']} ms, {result['errors']} errors, "
+                  f"{result['upstream_throttled']} upstream 429s", file=sys.stderr)
+    finally:
+        if proxy_server is not None:
+            proxy_server.shutdown()
+        mock.stop()
+
+    print_table(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f'regression: {line}', file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,21 @@
 import json
-from flask import Flask,request
-from flask_restx import Api, Resource,reqparse,fields
+import os
+from collections import Counter
+from functools import lru_cache, partial
+from itertools import chain
+from flask import Flask,Response,g,request
+from flask_restx import Api, Resource,abort,reqparse,fields,inputs
 import requests
 
-app = Flask(__name__)
-api = Api(app, version='1.0', title='Bitbucket API', description='Bitbucket API operations')
+import audit
+import cache
+import metrics
+import upstream
+
+CLIENT_CACHE_SIZE = int(os.environ.get('CLIENT_CACHE_SIZE', '256'))
+
+# Resources are registered on ``api`` at import; the Flask app is built by create_app
+api = Api(version='1.0', title='Bitbucket API', description='Bitbucket API operations')
 
 ns = api.namespace('Bitbucket', description='Bitbucket operations')
 
@@ -14,6 +25,14 @@ parser.add_argument('BITBUCKET_TOKEN', type=str, required=False)
 parser.add_argument('BITBUCKET_USERNAME', type=str, required=False, help='Bitbucket username')
 parser.add_argument('BITBUCKET_PASSWORD', type=str, required=False, help='Bitbucket password')
 
+# The parsers below only hold the arguments a resource adds to ``parser``, which
+# ``client`` reads; they are read from the query string only.
+page_parser = reqparse.RequestParser()
+page_parser.add_argument('all_pages', type=inputs.boolean, default=False, help='Walk every page and stream the result')
+page_parser.add_argument('limit', type=inputs.positive, required=False, help='Page size requested from Bitbucket')
+page_parser.add_argument('start', type=inputs.natural, required=False, help='Index of the first item')
+page_parser.add_argument('format', choices=('json', 'ndjson'), default='json', help='Streaming format used with all_pages')
+
 project_model = api.model('Project', {
     'key': fields.String(required=True, description='Project key'),
     'name': fields.String(required=True, description='Project name'),
@@ -29,23 +48,168 @@ repo_model = api.model('Repository', {
     'description': fields.String(required=False, description='Repository description')
 })
 
+project_key_model = api.model('ProjectKey', {
+    'key': fields.String(required=True, description='Project key')
+})
+
+repo_key_model = api.model('RepositoryKey', {
+    'project_key': fields.String(required=True, description='Project key'),
+    'slug': fields.String(required=True, description='Repository slug')
+})
+
+batch_repo_model = api.inherit('BatchRepository', repo_model, {
+    'project_key': fields.String(required=True, description='Key of the project the repository is created in')
+})
+
+# Bitbucket Server schedules repository deletion and may answer 202 instead of 204
+REPO_DELETED = (202, 204)
+
+batch_parser = reqparse.RequestParser()
+batch_parser.add_argument('if_missing', type=inputs.boolean, default=False, help='Report items that already exist as done instead of failed')
+batch_parser.add_argument('max_workers', type=inputs.positive, required=False, help='Number of items sent to Bitbucket concurrently')
+batch_parser.add_argument('deadline', type=float, required=False, help='Seconds to wait for the whole batch; by default it waits for every item')
+
+audit_parser = reqparse.RequestParser()
+audit_parser.add_argument('user', type=str, required=False, help='Only report this user')
+audit_parser.add_argument('group', type=str, required=False, help='Only report this group')
+audit_parser.add_argument('permission', choices=audit.PERMISSIONS, required=False, help='Only report this permission level')
+audit_parser.add_argument('refresh', type=inputs.boolean, default=False, help='Fetch the permissions of every project again')
+audit_parser.add_argument('max_workers', type=inputs.positive, required=False, help='Number of projects fetched concurrently')
+audit_parser.add_argument('deadline', type=float, required=False, help='Seconds to wait for the permissions of all projects')
+
+for extra_parser in (page_parser, batch_parser, audit_parser):
+    for argument in extra_parser.args:
+        argument.location = 'args'
+
+
+class Client:
+    """Upstream URL and credentials of a caller, with the headers built from them.
+
+    Instances are shared by every request with the same arguments and must not
+    be modified.
+    """
+    __slots__ = ('url', 'auth', 'headers', 'write_headers', 'delete_headers')
+
+    def __init__(self, url, token=None, username=None, password=None):
+        self.url = url
+        self.auth = (username, password)
+        self.headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {token}'
+        }
+        self.write_headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+        }
+        self.delete_headers = {**self.headers, 'Accept': 'application/json'}
+
+
+@lru_cache(maxsize=CLIENT_CACHE_SIZE)
+def client_for(url, token=None, username=None, password=None):
+    return Client(url, token, username, password)
+
+
+def client():
+    """Return the upstream client of the current request.
+
+    The arguments documented by ``parser`` are read once per request, from a
+    JSON object body or else the query string and form, as reqparse does.
+    """
+    current = g.get('bitbucket_client')
+    if current is None:
+        body = request.get_json(silent=True) if request.is_json else None
+        sources = [body, request.values] if isinstance(body, dict) else [request.values]
+        values = {}
+        for argument in parser.args:
+            for source in sources:
+                if source.get(argument.name) is not None:
+                    values[argument.name] = str(source[argument.name])
+                    break
+        if 'BITBUCKET_URL' not in values:
+            abort(400, 'Input payload validation failed', errors={
+                'BITBUCKET_URL': 'Missing required parameter in the JSON body or the post body or the query string'})
+        current = g.bitbucket_client = client_for(values['BITBUCKET_URL'], values.get('BITBUCKET_TOKEN'),
+                                                  values.get('BITBUCKET_USERNAME'), values.get('BITBUCKET_PASSWORD'))
+    return current
+
+def page_params(args):
+    """Return the Bitbucket paging query parameters given by the caller"""
+    return {key: args[key] for key in ('limit', 'start') if args.get(key) is not None}
+
+def stream_response(items, fmt, envelope=True):
+    """Stream batches of items as NDJSON or as one JSON document.
+
+    ``items`` yields lists of JSON-serialisable values. With ``envelope`` the
+    JSON document looks like a single Bitbucket page, otherwise it is a plain
+    array. Upstream failures after the first byte are reported in-band.
+    """
+    def generate():
+        size = 0
+        error = None
+        if fmt == 'json':
+            yield '{"values": [' if envelope else '['
+        try:
+            for batch in items:
+                if not batch:
+                    continue
+                if fmt == 'ndjson':
+                    yield ''.join(json.dumps(item) + '\n' for item in batch)
+                else:
+                    yield (',' if size else '') + ','.join(json.dumps(item) for item in batch)
+                size += len(batch)
+        except (upstream.UpstreamError, requests.exceptions.RequestException, ValueError) as e:
+            error = str(e)
+        if fmt == 'ndjson':
+            if error:
+                yield json.dumps({"error": error}) + '\n'
+        elif envelope:
+            tail = {'size': size, 'isLastPage': error is None}
+            if error:
+                tail['error'] = error
+            yield '], ' + json.dumps(tail)[1:]
+        elif error:
+            yield (',' if size else '') + json.dumps({"error": error}) + ']'
+        else:
+            yield ']'
+
+    mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+    return Response(generate(), mimetype=mimetype)
+
+def stream_pages(url, headers, args):
+    """Stream every page of an upstream collection to the client"""
+    pages = upstream.iter_pages(url, params=page_params(args), headers=headers)
+    try:
+        first_page = next(pages)
+    except upstream.UpstreamError as e:
+        return {"error": str(e)}, 500
+    except json.JSONDecodeError as e:
+        return {"error": f"Error decoding JSON: {str(e)}"}, 500
+    values = (page.get('values', []) for page in chain([first_page], pages))
+    return stream_response(values, args['format'])
+
+def invalidate_project(bitbucket_url, project_key):
+    """Drop cached reads of a project, everything below it and the project list"""
+    cache.responses.invalidate(f'{bitbucket_url}/projects', prefix=False)
+    cache.responses.invalidate(f'{bitbucket_url}/projects/{project_key}')
+
 @ns.route('/users')
 class UserList(Resource):
     @api.doc('list_users')
-    @api.expect(parser)
+    @api.expect(parser, page_parser)
     def get(self):
         """List all Bitbucket users"""
-        args = parser.parse_args()  # Parse the request parameters
+        args = page_parser.parse_args()  # Parse the request parameters
         
-        # Retrieve the values of BITBUCKET_URL and BITBUCKET_TOKEN from args
-        BITBUCKET_URL = args['BITBUCKET_URL']
-        BITBUCKET_TOKEN = args['BITBUCKET_TOKEN']
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {BITBUCKET_TOKEN}'
-        }
-        response = requests.get(f'{BITBUCKET_URL}/users', 
-                                headers=headers)
+        # Retrieve BITBUCKET_URL and the headers built from BITBUCKET_TOKEN
+        caller = client()
+        BITBUCKET_URL = caller.url
+        headers = caller.headers
+        if args['all_pages']:
+            return stream_pages(f'{BITBUCKET_URL}/users', headers, args)
+        response = cache.responses.get(f'{BITBUCKET_URL}/users',
+                                       cache.TTL['users'],
+                                       headers=headers,
+                                       params=page_params(args))
 
         if response.status_code == 200:
             try:
@@ -57,50 +221,71 @@ class UserList(Resource):
         else:
             return {"error": f"Request failed with status code: {response.status_code}"}, 500
 
+fanout_parser = page_parser.copy()
+fanout_parser.add_argument('max_workers', type=inputs.positive, required=False, location='args', help='Number of projects fetched concurrently')
+fanout_parser.add_argument('deadline', type=float, required=False, location='args', help='Seconds to wait for all repository fetches')
+
 @ns.route('/projects')
 class ProjectList(Resource):
     @api.doc('list_projects')
-    @api.expect(parser)
+    @api.expect(parser, fanout_parser)
     def get(self):
         """List all Bitbucket projects"""
-        args = parser.parse_args()  
-
-        BITBUCKET_URL = args['BITBUCKET_URL']
-        BITBUCKET_TOKEN = args['BITBUCKET_TOKEN']
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {BITBUCKET_TOKEN}'
-        }
-        all_projects_and_repos = []
-
-        response = requests.get(f'{BITBUCKET_URL}/projects', 
-                                headers=headers)
-        projects_data = response.json()
-
-        for project in projects_data['values']:
-            project_key = project['key']
-
-            # repositories_url = f'{BITBUCKET_URL}/projects/{project_key}/repos'
-            response = requests.get(f'{BITBUCKET_URL}/projects/{project_key}/repos',
-                                     headers=headers)
+        args = fanout_parser.parse_args()  
+
+        caller = client()
+        BITBUCKET_URL = caller.url
+        headers = caller.headers
+
+        def fetch_repositories(project):
+            url = f'{BITBUCKET_URL}/projects/{project["key"]}/repos'
+            if args['all_pages']:
+                return list(upstream.iter_values(url, headers=headers))
+            response = cache.responses.get(url, cache.TTL['repos'], headers=headers)
+            if response.status_code != 200:
+                raise upstream.UpstreamError(response.status_code)
+            return response.json()['values']
+
+        def with_repositories(projects):
+            # Repositories are fetched concurrently; results keep the project order
+            results = upstream.fan_out(fetch_repositories, projects,
+                                       max_workers=args['max_workers'],
+                                       deadline=args['deadline'])
+            projects_and_repos = []
+            for project, (repositories, error) in zip(projects, results):
+                project_info = {
+                    'project_name': project['name'],
+                    'repositories': repositories or []
+                }
+                if error is not None:
+                    project_info['error'] = str(error)
+                projects_and_repos.append(project_info)
+            return projects_and_repos
+
+        # Streamed walks are not cached, single pages are
+        fetch = None if args['all_pages'] else partial(cache.responses.get, ttl=cache.TTL['projects'])
+        pages = upstream.iter_pages(f'{BITBUCKET_URL}/projects',
+                                    params=page_params(args),
+                                    fetch=fetch,
+                                    headers=headers)
+        try:
+            first_page = next(pages)
+        except upstream.UpstreamError as e:
+            return {"error": str(e)}, 500
 
-            repositories_data = response.json()
-            project_info = {
-                'project_name': project['name'],
-                'repositories': repositories_data['values']
-            }
-            all_projects_and_repos.append(project_info)
-        return all_projects_and_repos
+        if args['all_pages']:
+            # One page of projects at a time is expanded and sent to the client
+            batches = (with_repositories(page['values']) for page in chain([first_page], pages))
+            return stream_response(batches, args['format'], envelope=False)
+        return with_repositories(first_page['values'])
 
     @api.doc('create_project')
     @api.expect(parser,project_model)
     def post(self):
         """Create a new Bitbucket project"""
-        args = parser.parse_args() 
+        caller = client()
         
-        BITBUCKET_URL = args['BITBUCKET_URL']
-        BITBUCKET_USERNAME = args['BITBUCKET_USERNAME']
-        BITBUCKET_PASSWORD = args['BITBUCKET_PASSWORD']
+        BITBUCKET_URL = caller.url
         data = request.json
         
         payload = {
@@ -108,18 +293,14 @@ class ProjectList(Resource):
                 'name': data['name'],
                 'description': data['description']
             }
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-        }
-        
         try:
-            response = requests.post(f'{BITBUCKET_URL}/projects', 
-                                     headers=headers, 
+            response = upstream.post(f'{BITBUCKET_URL}/projects', 
+                                     headers=caller.write_headers, 
                                      json=payload,
-                                     auth=(BITBUCKET_USERNAME, BITBUCKET_PASSWORD))
+                                     auth=caller.auth)
 
             if response.status_code == 201:
+                cache.responses.invalidate(f'{BITBUCKET_URL}/projects', prefix=False)
                 response_data = response.json()
                 return response_data, 201
             else:
@@ -134,17 +315,12 @@ class Project(Resource):
     @api.expect(parser)
     def get(self, project_key):
         """Get a specific Bitbucket project by project key"""
-        args = parser.parse_args()  
-
-        BITBUCKET_URL = args['BITBUCKET_URL']
-        BITBUCKET_TOKEN = args['BITBUCKET_TOKEN']
-        
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {BITBUCKET_TOKEN}'
-        }
-        response = requests.get(f'{BITBUCKET_URL}/projects/{project_key}', 
-                                headers=headers)
+        caller = client()
+        BITBUCKET_URL = caller.url
+        headers = caller.headers
+        response = cache.responses.get(f'{BITBUCKET_URL}/projects/{project_key}',
+                                       cache.TTL['project'],
+                                       headers=headers)
 
         if response.status_code == 200:
             try:
@@ -160,36 +336,22 @@ class Project(Resource):
     @api.expect(parser)
     def delete(self, project_key):
         """Delete a Bitbucket project by project key"""
-        args = parser.parse_args()
+        caller = client()
 
-        BITBUCKET_URL = args['BITBUCKET_URL']
-        BITBUCKET_TOKEN = args['BITBUCKET_TOKEN']
-        BITBUCKET_USERNAME = args['BITBUCKET_USERNAME']
-        BITBUCKET_PASSWORD = args['BITBUCKET_PASSWORD']
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {BITBUCKET_TOKEN}',
-            'Accept': 'application/json'
-        }
+        BITBUCKET_URL = caller.url
         try:
-            # Check if the project exists before deleting
-            check_response = requests.get(f'{BITBUCKET_URL}/projects/{project_key}', 
-                                          headers=headers)
-
-            if check_response.status_code == 200:
-                # Project exists, proceed to delete
-                delete_response = requests.delete(f'{BITBUCKET_URL}/projects/{project_key}', 
-                                                  headers=headers,
-                                                  auth=(BITBUCKET_USERNAME, BITBUCKET_PASSWORD))
-
-                if delete_response.status_code == 204:
-                    return {"message": "Project deleted successfully"}, 204
-                else:
-                    return {"error": f"Failed to delete project with status code: {delete_response.status_code}"}, 500
-            elif check_response.status_code == 404:
+            # Bitbucket answers 404 for a missing project, so no existence check is needed
+            delete_response = upstream.delete(f'{BITBUCKET_URL}/projects/{project_key}', 
+                                              headers=caller.delete_headers,
+                                              auth=caller.auth)
+
+            if delete_response.status_code == 204:
+                invalidate_project(BITBUCKET_URL, project_key)
+                return {"message": "Project deleted successfully"}, 204
+            elif delete_response.status_code == 404:
                 return {"error": f"Project with key {project_key} not found"}, 404
             else:
-                return {"error": f"Failed to check project existence with status code: {check_response.status_code}"}, 500
+                return {"error": f"Failed to delete project with status code: {delete_response.status_code}"}, 500
         except requests.exceptions.RequestException as e:
             return {"error": f"Request failed: {str(e)}"}, 500
     
@@ -197,11 +359,9 @@ class Project(Resource):
     @api.expect(parser, project_model)
     def put(self, project_key):
         """Update a Bitbucket project by project key"""
-        args = parser.parse_args()
+        caller = client()
 
-        BITBUCKET_URL = args['BITBUCKET_URL']
-        BITBUCKET_USERNAME = args['BITBUCKET_USERNAME']
-        BITBUCKET_PASSWORD = args['BITBUCKET_PASSWORD']
+        BITBUCKET_URL = caller.url
         data = request.json
 
         project_data = {
@@ -210,19 +370,15 @@ class Project(Resource):
             'description': data.get('description')
         }
 
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-        }
-
         try:
             # Update the project using the provided project key
-            update_response = requests.put(f'{BITBUCKET_URL}/projects/{project_key}', 
-                                           headers=headers, 
+            update_response = upstream.put(f'{BITBUCKET_URL}/projects/{project_key}', 
+                                           headers=caller.write_headers, 
                                            json=project_data, 
-                                           auth=(BITBUCKET_USERNAME, BITBUCKET_PASSWORD))
+                                           auth=caller.auth)
 
             if update_response.status_code == 200:
+                invalidate_project(BITBUCKET_URL, project_key)
                 updated_data = update_response.json()
                 return updated_data, 200
             else:
@@ -235,18 +391,18 @@ class Project(Resource):
 @ns.route('/project/<project_key>/repos')
 class ProjectRepos(Resource):
     @api.doc('list_project_repos')
-    @api.expect(parser)
+    @api.expect(parser, page_parser)
     def get(self, project_key):
         """List repositories of a specific Bitbucket project by project key"""
-        args = parser.parse_args() 
-
-        BITBUCKET_URL = args['BITBUCKET_URL']
-        BITBUCKET_TOKEN = args['BITBUCKET_TOKEN']
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {BITBUCKET_TOKEN}'
-        }
-        response = requests.get(f'{BITBUCKET_URL}/projects/{project_key}/repos', headers=headers)
+        args = page_parser.parse_args() 
+
+        caller = client()
+        BITBUCKET_URL = caller.url
+        headers = caller.headers
+        if args['all_pages']:
+            return stream_pages(f'{BITBUCKET_URL}/projects/{project_key}/repos', headers, args)
+        response = cache.responses.get(f'{BITBUCKET_URL}/projects/{project_key}/repos', cache.TTL['repos'],
+                                       headers=headers, params=page_params(args))
         if response.status_code == 200:
             try:
                 response_data = response.json()
@@ -260,28 +416,23 @@ class ProjectRepos(Resource):
     @api.expect(parser,repo_model)
     def post(self, project_key):
         """Create a Bitbucket repository in a specific project by project key"""
-        args = parser.parse_args() 
+        caller = client()
         data =request.json
         
-        BITBUCKET_URL = args['BITBUCKET_URL']
-        BITBUCKET_USERNAME = args['BITBUCKET_USERNAME']
-        BITBUCKET_PASSWORD = args['BITBUCKET_PASSWORD']
+        BITBUCKET_URL = caller.url
 
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-        }
         repo_data = {
         "name": data['name'], 
         "public": data['public'], 
         "description": data['description'] 
     }
-        response = requests.post(f'{BITBUCKET_URL}/projects/{project_key}/repos',
-                                 headers=headers, 
+        response = upstream.post(f'{BITBUCKET_URL}/projects/{project_key}/repos',
+                                 headers=caller.write_headers, 
                                  json=repo_data,
-                                 auth=(BITBUCKET_USERNAME, BITBUCKET_PASSWORD))
+                                 auth=caller.auth)
         
         if response.status_code == 201:  # 201 indicates the resource was created.
+            cache.responses.invalidate(f'{BITBUCKET_URL}/projects/{project_key}/repos')
             try:
                 response_data = response.json()
                 return response_data, 201
@@ -295,52 +446,37 @@ class ProjectRepo(Resource):
     @api.doc('delete_repo')
     @api.expect(parser)
     def delete(self,project_key,repositorySlug):
-        args = parser.parse_args()
-        BITBUCKET_URL = args['BITBUCKET_URL']
-        BITBUCKET_USERNAME = args['BITBUCKET_USERNAME']
-        BITBUCKET_PASSWORD = args['BITBUCKET_PASSWORD']
-        BITBUCKET_TOKEN = args['BITBUCKET_TOKEN']
+        caller = client()
+        BITBUCKET_URL = caller.url
 
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'Authorization': f'Bearer {BITBUCKET_TOKEN}'
-        }
-        response = requests.get(f'{BITBUCKET_URL}/projects/{project_key}/repos/{repositorySlug}', 
-                                headers=headers, 
-                                auth=(BITBUCKET_USERNAME, BITBUCKET_PASSWORD))
+        # Bitbucket answers 404 for a missing repository, so no existence check is needed
+        response = upstream.delete(f'{BITBUCKET_URL}/projects/{project_key}/repos/{repositorySlug}', 
+                                   headers=caller.delete_headers, 
+                                   auth=caller.auth)
 
-        if response.status_code == 200:
-            # Repository exists, proceed with deletion
-            response = requests.delete(f'{BITBUCKET_URL}/projects/{project_key}/repos/{repositorySlug}', 
-                                       headers=headers, 
-                                       auth=(BITBUCKET_USERNAME, BITBUCKET_PASSWORD))
-            
-            if response.status_code == 204:  # 204 indicates a successful deletion.
-                return {"message": "Repository deleted successfully"}, 204
-            else:
-                return {"error": f"Failed to delete the repository with status code: {response.status_code}"}, 500
+        if response.status_code in REPO_DELETED:
+            cache.responses.invalidate(f'{BITBUCKET_URL}/projects/{project_key}/repos')
+            return {"message": "Repository deleted successfully"}, 204
         elif response.status_code == 404:
             # Repository does not exist
             return {"message": "Repository does not exist"}, 404
         else:
-            return {"error": f"Request to check repository existence failed with status code: {response.status_code}"}, 500
+            return {"error": f"Failed to delete the repository with status code: {response.status_code}"}, 500
         
 @ns.route('/projects/<project_key>/permissions/users')
 class ProjectUsers(Resource):
     @api.doc('list_project_users')
-    @api.expect(parser)
+    @api.expect(parser, page_parser)
     def get(self, project_key):
         """List users of a specific Bitbucket project by project key"""
-        args = parser.parse_args() 
-
-        BITBUCKET_URL = args['BITBUCKET_URL']
-        BITBUCKET_TOKEN = args['BITBUCKET_TOKEN']
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {BITBUCKET_TOKEN}'
-        }
-        response = requests.get(f'{BITBUCKET_URL}/projects/{project_key}/permissions/users', headers=headers)
+        args = page_parser.parse_args() 
+
+        caller = client()
+        BITBUCKET_URL = caller.url
+        headers = caller.headers
+        if args['all_pages']:
+            return stream_pages(f'{BITBUCKET_URL}/projects/{project_key}/permissions/users', headers, args)
+        response = upstream.get(f'{BITBUCKET_URL}/projects/{project_key}/permissions/users', headers=headers, params=page_params(args))
         if response.status_code == 200:
             try:
                 response_data = response.json()
@@ -350,5 +486,208 @@ class ProjectUsers(Resource):
         else:
             return {"error": f"Request failed with status code: {response.status_code}"}, 500
 
+def batch_items():
+    """Return the JSON array posted to a batch endpoint, or None"""
+    data = request.get_json(silent=True)
+    return data if isinstance(data, list) else None
+
+def require_fields(item, *names):
+    if not isinstance(item, dict):
+        raise ValueError('Item must be an object')
+    missing = [name for name in names if not item.get(name)]
+    if missing:
+        raise ValueError(f"Missing required fields: {', '.join(missing)}")
+
+BATCH_INCOMPLETE = ('failed', 'timed_out', 'not_started')
+
+def run_batch(func, items, args, identity):
+    """Apply ``func`` to every item concurrently and report one outcome per item.
+
+    ``func`` returns a dict with at least a ``status``; ``identity`` names the
+    item fields echoed back so callers can match outcomes to their input.
+    Writes cannot be taken back, so the batch waits for every item unless a
+    ``deadline`` is given; items still running then are ``timed_out`` (they
+    may yet succeed) and items not sent yet are ``not_started``.
+    """
+    results = upstream.fan_out(func, items, max_workers=args['max_workers'], deadline=args['deadline'] or 0)
+    outcomes = []
+    for item, (outcome, error) in zip(items, results):
+        echoed = {name: item.get(name) for name in identity} if isinstance(item, dict) else {}
+        if isinstance(error, upstream.DeadlineExceeded):
+            outcome = {'status': 'timed_out' if error.started else 'not_started', 'error': str(error)}
+        elif error is not None:
+            outcome = {'status': 'failed', 'error': str(error)}
+        outcomes.append({**echoed, **outcome})
+    summary = dict(Counter(outcome['status'] for outcome in outcomes))
+    incomplete = any(status in summary for status in BATCH_INCOMPLETE)
+    return {'results': outcomes, 'summary': summary}, 207 if incomplete else 200
+
+@ns.route('/projects/batch')
+class ProjectBatch(Resource):
+    @api.doc('create_projects')
+    @api.expect(parser, batch_parser, [project_model])
+    def post(self):
+        """Create many Bitbucket projects concurrently"""
+        args = batch_parser.parse_args()
+        items = batch_items()
+        if items is None:
+            return {"error": "Request body must be a JSON array of projects"}, 400
+
+        caller = client()
+        BITBUCKET_URL = caller.url
+        auth = caller.auth
+        headers = caller.write_headers
+
+        def create(item):
+            require_fields(item, 'key', 'name')
+            payload = {
+                'key': item['key'],
+                'name': item['name'],
+                'description': item.get('description')
+            }
+            response = upstream.post(f'{BITBUCKET_URL}/projects', headers=headers, json=payload, auth=auth)
+            if response.status_code == 201:
+                # Invalidated once the write has landed, even if the batch returned before it
+                cache.responses.invalidate(f'{BITBUCKET_URL}/projects', prefix=False)
+                return {'status': 'created'}
+            if response.status_code == 409 and args['if_missing']:
+                return {'status': 'exists'}
+            raise upstream.UpstreamError(response.status_code)
+
+        return run_batch(create, items, args, identity=('key',))
+
+    @api.doc('delete_projects')
+    @api.expect(parser, batch_parser, [project_key_model])
+    def delete(self):
+        """Delete many Bitbucket projects concurrently"""
+        args = batch_parser.parse_args()
+        items = batch_items()
+        if items is None:
+            return {"error": "Request body must be a JSON array of projects"}, 400
+
+        caller = client()
+        BITBUCKET_URL = caller.url
+        auth = caller.auth
+        headers = caller.delete_headers
+
+        def delete(item):
+            require_fields(item, 'key')
+            response = upstream.delete(f'{BITBUCKET_URL}/projects/{item["key"]}', headers=headers, auth=auth)
+            if response.status_code == 204:
+                invalidate_project(BITBUCKET_URL, item['key'])
+                return {'status': 'deleted'}
+            if response.status_code == 404:
+                return {'status': 'not_found'}
+            raise upstream.UpstreamError(response.status_code)
+
+        return run_batch(delete, items, args, identity=('key',))
+
+@ns.route('/repos/batch')
+class RepoBatch(Resource):
+    @api.doc('create_repos')
+    @api.expect(parser, batch_parser, [batch_repo_model])
+    def post(self):
+        """Create many Bitbucket repositories, in any projects, concurrently"""
+        args = batch_parser.parse_args()
+        items = batch_items()
+        if items is None:
+            return {"error": "Request body must be a JSON array of repositories"}, 400
+
+        caller = client()
+        BITBUCKET_URL = caller.url
+        auth = caller.auth
+        headers = caller.write_headers
+
+        def create(item):
+            require_fields(item, 'project_key', 'name')
+            repo_data = {
+                "name": item['name'],
+                "public": item.get('public', False),
+                "description": item.get('description')
+            }
+            response = upstream.post(f'{BITBUCKET_URL}/projects/{item["project_key"]}/repos',
+                                     headers=headers, json=repo_data, auth=auth)
+            if response.status_code == 201:
+                cache.responses.invalidate(f'{BITBUCKET_URL}/projects/{item["project_key"]}/repos')
+                return {'status': 'created', 'slug': response.json().get('slug')}
+            if response.status_code == 409 and args['if_missing']:
+                return {'status': 'exists'}
+            raise upstream.UpstreamError(response.status_code)
+
+        return run_batch(create, items, args, identity=('project_key', 'name'))
+
+    @api.doc('delete_repos')
+    @api.expect(parser, batch_parser, [repo_key_model])
+    def delete(self):
+        """Delete many Bitbucket repositories, in any projects, concurrently"""
+        args = batch_parser.parse_args()
+        items = batch_items()
+        if items is None:
+            return {"error": "Request body must be a JSON array of repositories"}, 400
+
+        caller = client()
+        BITBUCKET_URL = caller.url
+        auth = caller.auth
+        headers = caller.delete_headers
+
+        def delete(item):
+            require_fields(item, 'project_key', 'slug')
+            response = upstream.delete(f'{BITBUCKET_URL}/projects/{item["project_key"]}/repos/{item["slug"]}',
+                                       headers=headers, auth=auth)
+            if response.status_code in REPO_DELETED:
+                cache.responses.invalidate(f'{BITBUCKET_URL}/projects/{item["project_key"]}/repos')
+                return {'status': 'deleted'}
+            if response.status_code == 404:
+                return {'status': 'not_found'}
+            raise upstream.UpstreamError(response.status_code)
+
+        return run_batch(delete, items, args, identity=('project_key', 'slug'))
+
+@ns.route('/permissions/audit')
+class PermissionsAudit(Resource):
+    @api.doc('audit_permissions')
+    @api.expect(parser, audit_parser)
+    def get(self):
+        """Index user and group permissions of every project by user and group"""
+        args = audit_parser.parse_args()
+        caller = client()
+
+        try:
+            report = audit.audits.run(caller.url, caller.headers,
+                                      user=args['user'], group=args['group'], permission=args['permission'],
+                                      refresh=args['refresh'], max_workers=args['max_workers'],
+                                      deadline=args['deadline'])
+        except upstream.UpstreamError as e:
+            return {"error": str(e)}, 500
+        except requests.exceptions.RequestException as e:
+            return {"error": f"Request failed: {str(e)}"}, 500
+        return report, 200
+
+@ns.route('/cache/stats')
+class CacheStats(Resource):
+    @api.doc('cache_stats')
+    def get(self):
+        """Hit, miss and size counters of the read cache"""
+        return cache.responses.stats(), 200
+
+def create_app():
+    """Build the proxy app"""
+    app = Flask(__name__)
+    api.init_app(app)
+    metrics.init_app(app)
+    return app
+
+_app = None
+
+def __getattr__(name):
+    # ``bitbucket.app`` is built on first use, so importing the module stays cheap
+    global _app
+    if name != 'app':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    if _app is None:
+        _app = create_app()
+    return _app
+
 if __name__ == '__main__':
-    app.run("0.0.0.0",5050,debug=True)
+    # Development server only; production runs under gunicorn (see gunicorn.conf.py)
+    create_app().run("0.0.0.0",5050,debug=os.environ.get('FLASK_DEBUG') == '1')
@@ -0,0 +1,120 @@
+"""In-process LRU cache with TTLs and conditional revalidation for upstream GETs."""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+import upstream
+
+MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', '1024'))
+
+# Seconds a cached response is served without asking upstream; 0 disables it
+TTL = {
+    'users': float(os.environ.get('CACHE_TTL_USERS', '60')),
+    'projects': float(os.environ.get('CACHE_TTL_PROJECTS', '30')),
+    'project': float(os.environ.get('CACHE_TTL_PROJECT', '30')),
+    'repos': float(os.environ.get('CACHE_TTL_REPOS', '30')),
+}
+
+
+class _Entry:
+    __slots__ = ('response', 'expires', 'etag', 'last_modified')
+
+    def __init__(self, response, ttl):
+        self.response = response
+        self.expires = time.monotonic() + ttl
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+
+
+class ResponseCache:
+    """LRU cache of successful upstream GET responses.
+
+    Entries are keyed by upstream URL (base URL and path), query parameters and
+    credential identity, so callers never see data fetched with someone else's
+    credentials.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get(self, url, ttl, params=None, headers=None, auth=None, **kwargs):
+        """GET ``url`` through the cache; behaves like ``upstream.get``"""
+        if ttl <= 0:
+            return upstream.get(url, params=params, headers=headers, auth=auth, **kwargs)
+        key = (url, tuple(sorted((params or {}).items())), upstream.credential_id(headers, auth))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if entry.expires > time.monotonic():
+                    self.hits += 1
+                    return entry.response
+            self.misses += 1
+
+        request_headers = dict(headers or {})
+        if entry is not None and entry.etag:
+            request_headers['If-None-Match'] = entry.etag
+        elif entry is not None and entry.last_modified:
+            request_headers['If-Modified-Since'] = entry.last_modified
+        response = upstream.get(url, params=params, headers=request_headers, auth=auth, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            with self._lock:
+                self.revalidated += 1
+                entry.expires = time.monotonic() + ttl
+            return entry.response
+        if response.status_code == 200:
+            self._store(key, _Entry(response, ttl))
+        return response
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, url, prefix=True):
+        """Drop entries for ``url`` and, with ``prefix``, every URL below it"""
+        url = url.rstrip('/')
+        with self._lock:
+            stale = [key for key in self._entries
+                     if key[0] == url or (prefix and key[0].startswith(url + '/'))]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidated': self.revalidated,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+            }
+
+
+responses = ResponseCache()
+
+
+@metrics.register_stats
+def _cache_stats():
+    for name, value in responses.stats().items():
+        yield f'bitbucket_cache_{name}', f'Read cache {name.replace("_", " ")}', {}, value
@@ -0,0 +1,53 @@
+"""Production gunicorn settings; every value can be overridden from the environment.
+
+Run the Bitbucket proxy with ``gunicorn -c gunicorn.conf.py`` or the migration
+service with ``APP_MODULE=repo:app gunicorn -c gunicorn.conf.py``.
+"""
+import multiprocessing
+import os
+import shutil
+
+wsgi_app = os.environ.get('APP_MODULE', 'bitbucket:app')
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', '5050')}")
+
+# gthread keeps a pool of threads per worker; upstream calls release the GIL
+# while waiting, so threads multiply the concurrency of each process.
+worker_class = os.environ.get('WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('THREADS', '8'))
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', '1000'))
+keepalive = int(os.environ.get('KEEPALIVE', '5'))
+timeout = int(os.environ.get('TIMEOUT', '120'))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', '30'))
+# Restarting workers would interrupt migration jobs running in them
+max_requests = int(os.environ.get('MAX_REQUESTS', '0'))
+max_requests_jitter = int(os.environ.get('MAX_REQUESTS_JITTER', '0'))
+preload_app = os.environ.get('PRELOAD_APP', 'false').lower() == 'true'
+
+accesslog = os.environ.get('ACCESS_LOG', '-')
+errorlog = os.environ.get('ERROR_LOG', '-')
+loglevel = os.environ.get('LOG_LEVEL', 'info')
+
+# Counters and histograms of all workers are aggregated through this directory;
+# it has to be set before prometheus_client is imported by the app.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/bitbucket-prometheus')
+
+
+def on_starting(server):
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def post_fork(server, worker):
+    import upstream
+
+    # Sockets opened in the master (with preload_app) must not be shared
+    upstream.close_all()
+    upstream.warm()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
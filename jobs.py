@@ -0,0 +1,344 @@
+"""Background migration jobs whose progress is persisted in SQLite."""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from migration import SUCCESS, Migration
+
+DB_PATH = os.environ.get('MIGRATION_JOBS_DB', 'migration_jobs.sqlite3')
+
+# Settings stored with a job; credentials are never written to disk
+SETTINGS = ('source_url', 'cloud_url', 'workspace', 'username', 'git_workers', 'api_workers', 'workdir',
+            'incremental', 'streaming', 'disk_budget')
+UNFINISHED = ('queued', 'running')
+# Seconds between heartbeats of a running job, and without one before it counts as interrupted
+HEARTBEAT_INTERVAL = float(os.environ.get('MIGRATION_JOB_HEARTBEAT_INTERVAL', '10'))
+HEARTBEAT_TIMEOUT = float(os.environ.get('MIGRATION_JOB_HEARTBEAT_TIMEOUT', '60'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    heartbeat_at REAL,
+    started_at REAL,
+    finished_at REAL,
+    projects_total INTEGER NOT NULL DEFAULT 0,
+    projects_done INTEGER NOT NULL DEFAULT 0,
+    repos_total INTEGER NOT NULL DEFAULT 0,
+    repos_done INTEGER NOT NULL DEFAULT 0,
+    repos_failed INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    current TEXT NOT NULL DEFAULT '[]',
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS job_repositories (
+    job_id TEXT NOT NULL,
+    project TEXT NOT NULL,
+    repository TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created INTEGER NOT NULL DEFAULT 0,
+    duration REAL,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (job_id, project, repository)
+);
+"""
+
+
+_owner_token = None
+
+
+def _owner():
+    """Identify this process; the random part tells apart processes that reuse a hostname and PID"""
+    global _owner_token
+    if _owner_token is None or _owner_token[0] != os.getpid():
+        _owner_token = (os.getpid(), f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:12]}')
+    return _owner_token[1]
+
+
+class JobStore:
+    """Jobs table access; every call uses its own short-lived connection"""
+
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+            columns = {row['name'] for row in db.execute('PRAGMA table_info(jobs)')}
+            if 'heartbeat_at' not in columns:
+                db.execute('ALTER TABLE jobs ADD COLUMN heartbeat_at REAL')
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _write(self, sql, params=()):
+        with self._lock, self._connect() as db:
+            return db.execute(sql, params).rowcount
+
+    def create(self, settings):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._write('INSERT INTO jobs (id, status, settings, owner, created_at, heartbeat_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (job_id, 'queued', json.dumps(settings), _owner(), now, now))
+        return job_id
+
+    def update(self, job_id, **fields):
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        self._write(f'UPDATE jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+
+    def increment(self, job_id, **fields):
+        assignments = ', '.join(f'{name} = {name} + ?' for name in fields)
+        self._write(f'UPDATE jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+
+    def record_result(self, job_id, result):
+        self._write('INSERT OR REPLACE INTO job_repositories '
+                    '(job_id, project, repository, status, created, duration, bytes, error) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (job_id, result['project'], result['repository'] or '', result['status'],
+                     int(result.get('created', False)), result.get('duration'),
+                     result.get('bytes', 0), result.get('error')))
+
+    def request_cancel(self, job_id):
+        return self._write("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status IN ('queued', 'running')",
+                           (job_id,)) > 0
+
+    def cancel_requested(self, job_id):
+        with self._connect() as db:
+            row = db.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return bool(row and row['cancel_requested'])
+
+    def row(self, job_id):
+        with self._connect() as db:
+            return db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+    def get(self, job_id):
+        row = self.row(job_id)
+        return progress(row) if row else None
+
+    def list(self):
+        with self._connect() as db:
+            rows = db.execute('SELECT * FROM jobs ORDER BY created_at DESC').fetchall()
+        return [progress(row) for row in rows]
+
+    def repositories(self, job_id):
+        with self._connect() as db:
+            rows = db.execute('SELECT project, repository, status, created, duration, bytes, error '
+                              'FROM job_repositories WHERE job_id = ? ORDER BY project, repository',
+                              (job_id,)).fetchall()
+        return [dict(row, created=bool(row['created']), repository=row['repository'] or None)
+                for row in rows]
+
+    def migrated(self, job_id):
+        """Return the (project, repository) pairs a job has already migrated"""
+        placeholders = ', '.join('?' * len(SUCCESS))
+        with self._connect() as db:
+            rows = db.execute('SELECT project, repository FROM job_repositories '
+                              f'WHERE job_id = ? AND status IN ({placeholders})', (job_id, *SUCCESS)).fetchall()
+        return {(row['project'], row['repository']) for row in rows}
+
+    def recover(self):
+        """Mark unfinished jobs without a recent heartbeat as interrupted"""
+        now = time.time()
+        self._write("UPDATE jobs SET status = 'interrupted', current = '[]', finished_at = ? "
+                    "WHERE status IN (?, ?) AND COALESCE(heartbeat_at, created_at) < ?",
+                    (now, *UNFINISHED, now - HEARTBEAT_TIMEOUT))
+
+
+def progress(row):
+    """Turn a jobs row into the progress report served by the API"""
+    started_at = row['started_at']
+    end = row['finished_at'] or time.time()
+    elapsed = end - started_at if started_at else 0.0
+    done = row['repos_done'] + row['repos_failed']
+    remaining = max(row['repos_total'] - done, 0)
+    eta = None
+    if row['status'] == 'running' and done and elapsed:
+        eta = round(elapsed / done * remaining, 1)
+    return {
+        'id': row['id'],
+        'status': row['status'],
+        'settings': json.loads(row['settings']),
+        'created_at': row['created_at'],
+        'started_at': started_at,
+        'finished_at': row['finished_at'],
+        'heartbeat_at': row['heartbeat_at'],
+        'cancel_requested': bool(row['cancel_requested']),
+        'projects': {'total': row['projects_total'], 'done': row['projects_done']},
+        'repositories': {'total': row['repos_total'], 'done': row['repos_done'], 'failed': row['repos_failed']},
+        'current': json.loads(row['current']),
+        'bytes': row['bytes'],
+        'throughput': round(row['bytes'] / elapsed, 1) if elapsed else 0.0,
+        'eta': eta,
+        'error': row['error'],
+    }
+
+
+class JobMigration(Migration):
+    """A migration that reports its progress to the job store"""
+
+    def __init__(self, store, job_id, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+        self.job_id = job_id
+        self._current = set()
+        self._remaining = {}
+
+    def should_stop(self):
+        if not self.cancelled.is_set() and self.store.cancel_requested(self.job_id):
+            self.cancelled.set()
+        return self.cancelled.is_set()
+
+    def projects_listed(self, projects):
+        self.store.update(self.job_id, projects_total=len(projects))
+
+    def repositories_listed(self, project, repositories):
+        with self._lock:
+            self._remaining[project['key']] = len(repositories)
+        self.store.increment(self.job_id, repos_total=len(repositories),
+                             projects_done=0 if repositories else 1)
+
+    def repository_started(self, project, repository):
+        with self._lock:
+            self._current.add(f"{project['key']}/{repository['name']}")
+            current = json.dumps(sorted(self._current))
+        self.store.update(self.job_id, current=current)
+
+    def repository_finished(self, result):
+        self.store.record_result(self.job_id, result)
+        project_done = 1 if result['repository'] is None else 0
+        with self._lock:
+            if result['repository'] is not None:
+                self._current.discard(f"{result['project']}/{result['repository']}")
+                self._remaining[result['project']] -= 1
+                project_done = int(self._remaining[result['project']] == 0)
+            current = json.dumps(sorted(self._current))
+        self.store.update(self.job_id, current=current)
+        self.store.increment(self.job_id,
+                             projects_done=project_done,
+                             repos_done=int(result['status'] in SUCCESS),
+                             repos_failed=int(result['status'] == 'failed'),
+                             bytes=result.get('bytes', 0))
+
+
+class JobRunner:
+    """Runs each submitted migration job on its own background thread"""
+
+    def __init__(self, store):
+        self.store = store
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def submit(self, settings, source_token, password):
+        job_id = self.store.create({name: settings.get(name) for name in SETTINGS})
+        self._start(job_id, settings, source_token, password, completed=())
+        return job_id
+
+    def resume(self, job_id, source_token, password):
+        """Restart an interrupted, failed or cancelled job, skipping migrated repositories"""
+        self.store.recover()
+        row = self.store.row(job_id)
+        with self._lock:
+            running_here = job_id in self._running
+        if row is None or row['status'] in UNFINISHED or running_here:
+            return False
+        completed = self.store.migrated(job_id)
+        self.store.update(job_id, status='queued', owner=_owner(), heartbeat_at=time.time(),
+                          cancel_requested=0, error=None,
+                          finished_at=None, current='[]', projects_done=0, projects_total=0, bytes=0,
+                          repos_total=len(completed), repos_done=len(completed), repos_failed=0)
+        self._start(job_id, json.loads(row['settings']), source_token, password, completed)
+        return True
+
+    def cancel(self, job_id):
+        self.store.recover()
+        requested = self.store.request_cancel(job_id)
+        with self._lock:
+            migration = self._running.get(job_id)
+        if migration is not None:
+            migration.cancel()
+        return requested
+
+    def _start(self, job_id, settings, source_token, password, completed):
+        migration = JobMigration(self.store, job_id,
+                                 source_url=settings['source_url'],
+                                 source_token=source_token,
+                                 cloud_url=settings['cloud_url'],
+                                 workspace=settings['workspace'],
+                                 username=settings['username'],
+                                 password=password,
+                                 git_workers=settings.get('git_workers'),
+                                 api_workers=settings.get('api_workers'),
+                                 workdir=settings.get('workdir'),
+                                 incremental=bool(settings.get('incremental')),
+                                 streaming=bool(settings.get('streaming')),
+                                 disk_budget=settings.get('disk_budget'),
+                                 completed=completed)
+        with self._lock:
+            self._running[job_id] = migration
+        threading.Thread(target=self._run, args=(job_id, migration),
+                         name=f'migration-{job_id}', daemon=True).start()
+
+    def _heartbeat(self, job_id, stopped):
+        while not stopped.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.store.update(job_id, heartbeat_at=time.time())
+            except sqlite3.Error:
+                pass  # the next beat tries again
+
+    def _run(self, job_id, migration):
+        self.store.update(job_id, status='running', started_at=time.time(), heartbeat_at=time.time())
+        stopped = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(job_id, stopped),
+                         name=f'migration-{job_id}-heartbeat', daemon=True).start()
+        try:
+            results = migration.run()
+            failed = sum(1 for result in results if result['status'] == 'failed')
+            error = None
+            if migration.cancelled.is_set():
+                status = 'cancelled'
+            elif failed:
+                # Resuming the job retries exactly these
+                status, error = 'failed', f'{failed} of {len(results)} repositories failed'
+            else:
+                status = 'completed'
+            self.store.update(job_id, status=status, error=error, current='[]', finished_at=time.time())
+        except Exception as e:
+            self.store.update(job_id, status='failed', error=str(e), current='[]', finished_at=time.time())
+        finally:
+            stopped.set()
+            with self._lock:
+                self._running.pop(job_id, None)
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_runner():
+    """Return the process-wide job runner, recovering jobs of dead processes once"""
+    global _runner
+    if _runner is None:
+        with _runner_lock:
+            if _runner is None:
+                store = JobStore()
+                store.recover()
+                _runner = JobRunner(store)
+    return _runner
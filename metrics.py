@@ -0,0 +1,161 @@
+"""Prometheus metrics for proxy requests, upstream calls, caches, pools and migrations."""
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, \
+    generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+SERVER_TIMING = os.environ.get('METRICS_SERVER_TIMING', 'false').lower() == 'true'
+
+GIT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+REQUEST_SECONDS = Histogram('bitbucket_proxy_request_seconds', 'Time spent serving proxy requests',
+                            ['endpoint', 'method'])
+REQUESTS = Counter('bitbucket_proxy_requests_total', 'Proxy requests served',
+                   ['endpoint', 'method', 'status'])
+REQUESTS_IN_FLIGHT = Gauge('bitbucket_proxy_requests_in_flight', 'Proxy requests being served',
+                           ['endpoint'], multiprocess_mode='livesum')
+UPSTREAM_SECONDS = Histogram('bitbucket_upstream_request_seconds', 'Latency of calls to upstream Bitbucket',
+                             ['host', 'method'])
+UPSTREAM_REQUESTS = Counter('bitbucket_upstream_requests_total',
+                            'Calls to upstream Bitbucket by status code or exception name',
+                            ['host', 'method', 'status'])
+UPSTREAM_IN_FLIGHT = Gauge('bitbucket_upstream_requests_in_flight', 'Calls to upstream Bitbucket waiting for an answer',
+                           ['host'], multiprocess_mode='livesum')
+UPSTREAM_COALESCED = Counter('bitbucket_upstream_coalesced_total',
+                             'Upstream GETs answered by an identical call already in flight', ['host'])
+GIT_SECONDS = Histogram('bitbucket_migration_git_seconds', 'Duration of git commands run by migrations',
+                        ['command'], buckets=GIT_BUCKETS)
+MIGRATED_BYTES = Counter('bitbucket_migration_bytes_total', 'Bytes fetched by repository transfers')
+MIGRATED_REPOSITORIES = Counter('bitbucket_migration_repositories_total', 'Repositories handled by migrations',
+                                ['status'])
+
+# Upstream time spent on behalf of the current proxy request, for Server-Timing
+_upstream_timings = contextvars.ContextVar('upstream_timings', default=None)
+
+_stats = []
+
+
+def register_stats(func):
+    """Expose gauges computed on scrape.
+
+    ``func`` yields ``(name, documentation, labels, value)`` tuples; it is used
+    for figures other modules already keep, such as cache and pool counters.
+    """
+    _stats.append(func)
+    return func
+
+
+class _StatsCollector:
+    def collect(self):
+        families = {}
+        for func in _stats:
+            for name, documentation, labels, value in func():
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = GaugeMetricFamily(name, documentation, labels=list(labels))
+                family.add_metric(list(labels.values()), value)
+        return list(families.values())
+
+
+_stats_collector = _StatsCollector()
+REGISTRY.register(_stats_collector)
+
+
+class _Call:
+    __slots__ = ('status',)
+
+    def __init__(self):
+        self.status = None
+
+
+@contextmanager
+def upstream_call(host, method):
+    """Time one upstream call; the caller sets ``status`` on the yielded object"""
+    call = _Call()
+    in_flight = UPSTREAM_IN_FLIGHT.labels(host)
+    in_flight.inc()
+    started = time.perf_counter()
+    try:
+        yield call
+    except Exception as e:
+        call.status = type(e).__name__
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        in_flight.dec()
+        UPSTREAM_SECONDS.labels(host, method).observe(elapsed)
+        UPSTREAM_REQUESTS.labels(host, method, str(call.status)).inc()
+        timings = _upstream_timings.get()
+        if timings is not None:
+            timings.append(elapsed)
+
+
+def observe_git(command, seconds):
+    GIT_SECONDS.labels(command).observe(seconds)
+
+
+def observe_migrated(result):
+    MIGRATED_REPOSITORIES.labels(result['status']).inc()
+    MIGRATED_BYTES.inc(result.get('bytes') or 0)
+
+
+def _endpoint():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def _start_request():
+    g.metrics_started = time.perf_counter()
+    g.metrics_endpoint = _endpoint()
+    _upstream_timings.set([])
+    REQUESTS_IN_FLIGHT.labels(g.metrics_endpoint).inc()
+
+
+def _finish_request(response):
+    started = g.get('metrics_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    REQUEST_SECONDS.labels(g.metrics_endpoint, request.method).observe(elapsed)
+    REQUESTS.labels(g.metrics_endpoint, request.method, str(response.status_code)).inc()
+    if SERVER_TIMING:
+        timings = _upstream_timings.get() or []
+        response.headers['Server-Timing'] = (f'app;dur={elapsed * 1000:.1f}, '
+                                             f'upstream;dur={sum(timings) * 1000:.1f};desc="{len(timings)} calls"')
+    return response
+
+
+def _teardown_request(error=None):
+    if g.get('metrics_started') is None:
+        return
+    REQUESTS_IN_FLIGHT.labels(g.metrics_endpoint).dec()
+    _upstream_timings.set(None)
+
+
+def _registry():
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    from prometheus_client import multiprocess
+
+    # Worker processes write their metrics to files; gauges computed on
+    # scrape only cover the worker answering it.
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(_stats_collector)
+    return registry
+
+
+def metrics_view():
+    return Response(generate_latest(_registry()), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_app(app):
+    """Record every request of ``app`` and serve the metrics on ``/metrics``"""
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,500 @@
+"""Parallel migration of projects and repositories from Bitbucket Server to Bitbucket Cloud."""
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+
+import metrics
+import upstream
+
+# Only branches and tags are synced; server-only refs such as pull requests are not
+SYNCED_REFS = ('refs/heads/', 'refs/tags/')
+MIRROR_DIR = '.mirrors'
+SUCCESS = ('migrated', 'unchanged')
+CLOUD_PAGE_SIZE = 100
+
+GIT_WORKERS = int(os.environ.get('MIGRATION_GIT_WORKERS', '4'))
+API_WORKERS = int(os.environ.get('MIGRATION_API_WORKERS', '8'))
+WORKDIR = os.environ.get('MIGRATION_WORKDIR', '.')
+SCRATCH_DIR = os.environ.get('MIGRATION_SCRATCH_DIR', '')
+# Scratch disk shared by concurrent streaming transfers, in bytes; 0 means unlimited
+DISK_BUDGET = int(os.environ.get('MIGRATION_DISK_BUDGET', '0'))
+# Assumed size of a repository whose size Bitbucket does not report
+REPO_SIZE_ESTIMATE = int(os.environ.get('MIGRATION_REPO_SIZE_ESTIMATE', str(256 * 1024 * 1024)))
+
+
+class MigrationError(Exception):
+    """A migration step (API call or git command) failed"""
+
+
+def disk_usage(path):
+    """Return the number of bytes used by the files below ``path``"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class DiskBudget:
+    """Reservations of scratch disk; transfers wait until their estimate fits.
+
+    A transfer larger than the whole budget still runs, but only on its own.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._changed = threading.Condition()
+
+    def acquire(self, size):
+        with self._changed:
+            while self.limit and self.used and self.used + size > self.limit:
+                self._changed.wait()
+            self.used += size
+
+    def adjust(self, reserved, actual):
+        """Replace a reservation by the size actually used on disk"""
+        with self._changed:
+            self.used += actual - reserved
+            self._changed.notify_all()
+
+    def release(self, size):
+        with self._changed:
+            self.used -= size
+            self._changed.notify_all()
+
+
+CREATE = 'create'
+CHANGED = 'changed'
+PRESENT = 'present'
+
+
+class Plan:
+    """Source projects and repositories diffed against the Cloud workspace.
+
+    Each source repository gets an action: ``create`` when Cloud does not have
+    it, ``changed`` when Cloud has it under another project or with other
+    settings, and ``present`` otherwise.
+    """
+
+    def __init__(self, projects, repositories, errors, cloud_projects, cloud_repositories):
+        self.projects = projects
+        self.repositories = repositories
+        self.errors = errors
+        self.projects_to_create = [project for project in projects
+                                   if project['key'] not in cloud_projects and project['key'] not in errors]
+        self.actions = {}
+        for project in projects:
+            for repository in repositories.get(project['key'], []):
+                self.actions[(project['key'], repository['slug'])] = self._diff(
+                    project, repository, cloud_repositories.get(repository['slug']))
+
+    @staticmethod
+    def _diff(project, repository, cloud_repository):
+        if cloud_repository is None:
+            return CREATE
+        if ((cloud_repository.get('project') or {}).get('key') != project['key']
+                or cloud_repository.get('is_private') != (not repository.get('public', False))
+                or (cloud_repository.get('description') or '') != (repository.get('description') or '')):
+            return CHANGED
+        return PRESENT
+
+    def action(self, project, repository):
+        return self.actions[(project['key'], repository['slug'])]
+
+    def summary(self):
+        """The plan as served by the dry-run endpoint"""
+        repositories = {CREATE: [], CHANGED: [], PRESENT: []}
+        for (project_key, slug), action in self.actions.items():
+            repositories[action].append(f'{project_key}/{slug}')
+        return {
+            'projects': {
+                'total': len(self.projects),
+                'create': [project['key'] for project in self.projects_to_create],
+            },
+            'repositories': {
+                'total': len(self.actions),
+                **repositories,
+            },
+            'errors': self.errors,
+        }
+
+
+class Migration:
+    """Copy every project and repository of a Bitbucket Server into a Cloud workspace.
+
+    Cloud API calls run on a pool of ``api_workers`` threads and git transfers
+    on a separate pool of ``git_workers`` threads, so slow clones never hold up
+    project or repository creation. Source and Cloud inventories are listed in
+    bulk first (see ``plan``) and only the difference is applied: missing
+    projects and repositories are created and transferred, changed ones are
+    updated. Repositories already in Cloud are pushed again unless their
+    branch and tag tips match the source, so a transfer that failed after the
+    Cloud repository was created is retried by the next run.
+
+    Repositories listed in ``completed`` as ``(project_key, repository_name)``
+    pairs are skipped, which lets an interrupted migration resume. With
+    ``incremental`` bare mirrors are kept under ``workdir`` between runs and
+    every repository is checked, but only those whose branch or tag tips
+    differ from Cloud are pushed. Otherwise, with ``streaming`` each
+    repository is cloned bare into a scratch directory, pushed and deleted,
+    and no more transfers run at once than fit into ``disk_budget`` bytes.
+
+    Subclasses can override the ``*_listed``, ``repository_started`` and
+    ``repository_finished`` hooks to follow progress.
+    """
+
+    def __init__(self, source_url, source_token, cloud_url, workspace, username, password,
+                 git_workers=None, api_workers=None, workdir=None, completed=None, incremental=False,
+                 streaming=False, disk_budget=None):
+        self.source_url = source_url.rstrip('/')
+        self.source_token = source_token
+        self.cloud_url = cloud_url.rstrip('/')
+        self.workspace = workspace
+        self.username = username
+        self.password = password
+        self.git_workers = git_workers or GIT_WORKERS
+        self.api_workers = api_workers or API_WORKERS
+        self.workdir = workdir or WORKDIR
+        self.completed = set(completed or ())
+        self.incremental = incremental
+        self.streaming = streaming
+        self.disk_budget = DiskBudget(DISK_BUDGET if disk_budget is None else disk_budget)
+        self.scratch_dir = SCRATCH_DIR or os.path.join(self.workdir, '.scratch')
+        self.created_items = []
+        self.results = []
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def cancel(self):
+        """Stop starting new repositories; transfers already running finish"""
+        self.cancelled.set()
+
+    def should_stop(self):
+        return self.cancelled.is_set()
+
+    def projects_listed(self, projects):
+        pass
+
+    def repositories_listed(self, project, repositories):
+        pass
+
+    def repository_started(self, project, repository):
+        pass
+
+    def repository_finished(self, result):
+        pass
+
+    @property
+    def source_headers(self):
+        return {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {self.source_token}'
+        }
+
+    @property
+    def auth(self):
+        return (self.username, self.password)
+
+    def _created(self, item):
+        with self._lock:
+            self.created_items.append(item)
+
+    def list_source_projects(self):
+        return list(upstream.iter_values(f'{self.source_url}/rest/api/1.0/projects',
+                                         headers=self.source_headers))
+
+    def list_source_repositories(self, project):
+        return list(upstream.iter_values(f'{self.source_url}/rest/api/1.0/projects/{project["key"]}/repos',
+                                         headers=self.source_headers))
+
+    def list_cloud_projects(self):
+        return {project['key']: project for project in upstream.iter_cloud_values(
+            f'{self.cloud_url}/workspaces/{self.workspace}/projects',
+            params={'pagelen': CLOUD_PAGE_SIZE}, auth=self.auth)}
+
+    def list_cloud_repositories(self):
+        return {repository['slug']: repository for repository in upstream.iter_cloud_values(
+            f'{self.cloud_url}/repositories/{self.workspace}',
+            params={'pagelen': CLOUD_PAGE_SIZE}, auth=self.auth)}
+
+    def plan(self):
+        """List both inventories in bulk and diff them"""
+        projects = self.list_source_projects()
+        listed = upstream.fan_out(self.list_source_repositories, projects,
+                                  max_workers=self.api_workers, deadline=0)
+        repositories = {}
+        errors = {}
+        for project, (values, error) in zip(projects, listed):
+            if error is not None:
+                errors[project['key']] = str(error)
+                continue
+            for repository in values:
+                repository.setdefault('slug', repository['name'])
+            repositories[project['key']] = values
+        return Plan(projects, repositories, errors,
+                    self.list_cloud_projects(), self.list_cloud_repositories())
+
+    def create_project(self, project):
+        new_project_data = {
+            "name": project['name'],
+            "key": project['key'],
+            "description": project.get('description', '')
+        }
+        response = upstream.post(f'{self.cloud_url}/workspaces/{self.workspace}/projects/',
+                                 json=new_project_data, auth=self.auth)
+        if response.status_code != 201:
+            raise upstream.UpstreamError(response.status_code,
+                                         f'Failed to create project with status code: {response.status_code}')
+        self._created(f"Project: {project['name']}")
+
+    @staticmethod
+    def cloud_repository_data(project, repository):
+        return {
+            "scm": "git",
+            "project": {
+                "key": project['key']
+            },
+            "is_private": not repository.get('public', False),
+            "description": repository.get('description', '')
+        }
+
+    def create_repository(self, project, repository):
+        """Create the Cloud repository; returns True when it did not exist yet"""
+        if self.should_stop():
+            return False
+        response = upstream.post(f'{self.cloud_url}/repositories/{self.workspace}/{repository["slug"]}',
+                                 json=self.cloud_repository_data(project, repository), auth=self.auth)
+        if response.status_code == 201:
+            self._created(f"Repository: {repository['name']}")
+            return True
+        return False
+
+    def update_repository(self, project, repository):
+        """Bring an existing Cloud repository's project and settings in line with the source"""
+        if self.should_stop():
+            return False
+        response = upstream.put(f'{self.cloud_url}/repositories/{self.workspace}/{repository["slug"]}',
+                                json=self.cloud_repository_data(project, repository), auth=self.auth)
+        if response.status_code != 200:
+            raise upstream.UpstreamError(response.status_code,
+                                         f'Failed to update repository with status code: {response.status_code}')
+        return False
+
+    def git_env(self):
+        """Environment for git subprocesses: never prompt, authenticate both remotes"""
+        env = dict(os.environ)
+        env.update({
+            'GIT_TERMINAL_PROMPT': '0',
+            'GIT_CONFIG_COUNT': '2',
+            'GIT_CONFIG_KEY_0': f'http.{self.source_url}/.extraHeader',
+            'GIT_CONFIG_VALUE_0': f'Authorization: Bearer {self.source_token}',
+            'GIT_CONFIG_KEY_1': 'credential.https://bitbucket.org.helper',
+            'GIT_CONFIG_VALUE_1': '!f() { echo "password=$MIGRATION_CLOUD_PASSWORD"; }; f',
+            'MIGRATION_CLOUD_PASSWORD': self.password or '',
+        })
+        return env
+
+    def git(self, *args, cwd=None):
+        started = time.monotonic()
+        completed = subprocess.run(['git', *args], cwd=cwd, env=self.git_env(),
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        elapsed = time.monotonic() - started
+        metrics.observe_git(args[0], elapsed)
+        timings = getattr(self._local, 'git_seconds', None)
+        if timings is not None:
+            timings[args[0]] = round(timings.get(args[0], 0) + elapsed, 3)
+        if completed.returncode != 0:
+            raise MigrationError(f'git {args[0]} failed: {completed.stderr.strip()}')
+        return completed.stdout
+
+    def clone_url(self, project, repository):
+        return f'{self.source_url}/scm/{project["key"]}/{repository["slug"]}.git'
+
+    def cloud_remote_url(self, repository):
+        return f'https://{quote(self.username, safe="")}@bitbucket.org/{self.workspace}/{repository["slug"]}.git'
+
+    def transfer_repository(self, project, repository):
+        """Move one repository to Cloud and return the fields to merge into its result"""
+        if self.incremental:
+            return self.sync_repository(project, repository)
+        if self.streaming:
+            return self.stream_repository(project, repository)
+        return self.copy_repository(project, repository)
+
+    def repository_size(self, project, repository):
+        """Size reported by Bitbucket Server, or the configured estimate"""
+        try:
+            response = upstream.get(f'{self.source_url}/projects/{project["key"]}/repos/{repository["slug"]}/sizes',
+                                    headers=self.source_headers)
+            if response.status_code == 200:
+                return int(response.json()['repository'])
+        except (ValueError, KeyError, TypeError, requests.exceptions.RequestException):
+            pass
+        return REPO_SIZE_ESTIMATE
+
+    def stream_repository(self, project, repository):
+        """Bare clone into scratch space, push branches and tags, then delete the clone"""
+        reserved = self.repository_size(project, repository)
+        self.disk_budget.acquire(reserved)
+        try:
+            os.makedirs(self.scratch_dir, exist_ok=True)
+            scratch = tempfile.mkdtemp(prefix=f'{project["key"]}-{repository["slug"]}-', dir=self.scratch_dir)
+            try:
+                mirror_path = os.path.join(scratch, 'repo.git')
+                self.git('clone', '--mirror', self.clone_url(project, repository), mirror_path)
+                fetched = disk_usage(mirror_path)
+                self.disk_budget.adjust(reserved, fetched)
+                reserved = fetched
+                self.git('push', '--prune', self.cloud_remote_url(repository),
+                         'refs/heads/*:refs/heads/*', 'refs/tags/*:refs/tags/*', cwd=mirror_path)
+            finally:
+                shutil.rmtree(scratch, ignore_errors=True)
+        finally:
+            self.disk_budget.release(reserved)
+        return {'bytes': fetched}
+
+    def copy_repository(self, project, repository):
+        """Fresh clone of the source repository, mirror-pushed to Cloud"""
+        local_repo_path = os.path.join(self.workdir, project['name'], repository['name'])
+        if os.path.exists(local_repo_path):
+            # A leftover clone from an earlier run would make git clone fail
+            shutil.rmtree(local_repo_path)
+        os.makedirs(local_repo_path)
+        self.git('clone', self.clone_url(project, repository), local_repo_path)
+        self.git('remote', 'add', 'cloud', self.cloud_remote_url(repository), cwd=local_repo_path)
+        self.git('fetch', '--all', cwd=local_repo_path)
+        self.git('push', '--mirror', 'cloud', cwd=local_repo_path)
+        return {'bytes': disk_usage(os.path.join(local_repo_path, '.git'))}
+
+    def ref_tips(self, *args, cwd=None):
+        """Parse ``git ls-remote`` output into {ref: sha} for branches and tags"""
+        tips = {}
+        for line in self.git('ls-remote', *args, cwd=cwd).splitlines():
+            sha, _, ref = line.partition('\t')
+            if ref.startswith(SYNCED_REFS) and not ref.endswith('^{}'):
+                tips[ref] = sha
+        return tips
+
+    def refresh_repository(self, project, repository):
+        """Transfer a repository already in Cloud unless its branch and tag tips match the source"""
+        if self.ref_tips(self.clone_url(project, repository)) == self.ref_tips(self.cloud_remote_url(repository)):
+            return {'status': 'unchanged', 'refs_changed': 0}
+        return self.transfer_repository(project, repository)
+
+    def sync_repository(self, project, repository):
+        """Update a persistent bare mirror and push only when branch or tag tips differ"""
+        mirror_path = os.path.join(self.workdir, MIRROR_DIR, project['key'], f'{repository["slug"]}.git')
+        size_before = 0
+        if os.path.isdir(mirror_path):
+            size_before = disk_usage(mirror_path)
+            self.git('remote', 'set-url', 'origin', self.clone_url(project, repository), cwd=mirror_path)
+            self.git('remote', 'update', '--prune', cwd=mirror_path)
+        else:
+            os.makedirs(os.path.dirname(mirror_path), exist_ok=True)
+            self.git('clone', '--mirror', self.clone_url(project, repository), mirror_path)
+        fetched = max(disk_usage(mirror_path) - size_before, 0)
+
+        cloud_url = self.cloud_remote_url(repository)
+        source_tips = self.ref_tips('.', cwd=mirror_path)
+        cloud_tips = self.ref_tips(cloud_url, cwd=mirror_path)
+        changed = {ref for ref in source_tips.keys() | cloud_tips.keys()
+                   if source_tips.get(ref) != cloud_tips.get(ref)}
+        if not changed:
+            return {'status': 'unchanged', 'bytes': fetched, 'refs_changed': 0}
+        self.git('push', '--prune', cloud_url,
+                 'refs/heads/*:refs/heads/*', 'refs/tags/*:refs/tags/*', cwd=mirror_path)
+        return {'bytes': fetched, 'refs_changed': len(changed)}
+
+    def migrate_repository(self, project, repository, action, created):
+        """Wait for the Cloud repository to be ready, then transfer it and report the outcome"""
+        result = {
+            'project': project['key'],
+            'repository': repository['name'],
+            'action': action,
+            'status': 'migrated',
+            'created': False,
+            'duration': 0.0,
+            'bytes': 0,
+        }
+        if self.should_stop():
+            result['status'] = 'cancelled'
+            self.repository_finished(result)
+            return result
+        self.repository_started(project, repository)
+        started = time.monotonic()
+        self._local.git_seconds = result['git_seconds'] = {}
+        try:
+            result['created'] = created.result()
+            if action == CREATE or self.incremental:
+                result.update(self.transfer_repository(project, repository))
+            else:
+                result.update(self.refresh_repository(project, repository))
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        result['duration'] = round(time.monotonic() - started, 3)
+        self._local.git_seconds = None
+        metrics.observe_migrated(result)
+        self.repository_finished(result)
+        return result
+
+    def project_failure(self, project, error):
+        """A finished future carrying the result for a project that could not be prepared"""
+        result = {
+            'project': project['key'],
+            'repository': None,
+            'status': 'failed',
+            'error': str(error),
+        }
+        self.repository_finished(result)
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def run(self, plan=None):
+        """Execute the plan and return the per-repository results in source order"""
+        plan = plan or self.plan()
+        self.projects_listed(plan.projects)
+        transfers = []
+        # The API pool is shut down first; git transfers keep running after it
+        with ThreadPoolExecutor(self.git_workers) as git_pool, \
+                ThreadPoolExecutor(self.api_workers) as api_pool:
+            # Repositories can only be created once their project exists
+            project_errors = dict(plan.errors)
+            to_create = plan.projects_to_create
+            outcomes = upstream.fan_out(self.create_project, to_create,
+                                        max_workers=self.api_workers, deadline=0)
+            for project, (_, error) in zip(to_create, outcomes):
+                if error is not None:
+                    project_errors[project['key']] = error
+            for project in plan.projects:
+                if project['key'] in project_errors:
+                    transfers.append(self.project_failure(project, project_errors[project['key']]))
+                    continue
+                repositories = [repository for repository in plan.repositories[project['key']]
+                                if (project['key'], repository['name']) not in self.completed]
+                self.repositories_listed(project, repositories)
+                for repository in repositories:
+                    action = plan.action(project, repository)
+                    if action == CREATE:
+                        created = api_pool.submit(self.create_repository, project, repository)
+                    elif action == CHANGED:
+                        created = api_pool.submit(self.update_repository, project, repository)
+                    else:
+                        created = Future()
+                        created.set_result(False)
+                    transfers.append(git_pool.submit(self.migrate_repository, project, repository, action, created))
+        self.results = [transfer.result() for transfer in transfers]
+        return self.results
@@ -0,0 +1,221 @@
+"""Per host and credential scheduling of upstream calls.
+
+Each limiter combines a token bucket (a fixed request rate), a pause while an
+upstream ``Retry-After`` is pending and a concurrency limit adapted by AIMD:
+the limit grows by about one per round of successful calls and is halved on a
+429 or cut back when latency rises above the target.
+"""
+import asyncio
+import os
+import threading
+from collections import deque
+import time
+from email.utils import parsedate_to_datetime
+
+import metrics
+
+RATE = float(os.environ.get('RATE_LIMIT_RPS', '0'))
+BURST = int(os.environ.get('RATE_LIMIT_BURST', '20'))
+INITIAL_CONCURRENCY = float(os.environ.get('RATE_LIMIT_INITIAL_CONCURRENCY', '8'))
+MIN_CONCURRENCY = float(os.environ.get('RATE_LIMIT_MIN_CONCURRENCY', '1'))
+MAX_CONCURRENCY = float(os.environ.get('RATE_LIMIT_MAX_CONCURRENCY', '64'))
+LATENCY_TARGET = float(os.environ.get('RATE_LIMIT_LATENCY_TARGET', '2'))
+# The aiohttp backend awaits admission instead of holding a thread, so it starts higher and may go further
+ASYNC_INITIAL_CONCURRENCY = float(os.environ.get('RATE_LIMIT_ASYNC_INITIAL_CONCURRENCY', '100'))
+ASYNC_MAX_CONCURRENCY = float(os.environ.get('RATE_LIMIT_ASYNC_MAX_CONCURRENCY', '1000'))
+# Retry-After used when a 429 does not carry one
+DEFAULT_RETRY_AFTER = float(os.environ.get('RATE_LIMIT_DEFAULT_RETRY_AFTER', '1'))
+# Longest pause honoured from a Retry-After; waiting callers hold threads meanwhile
+MAX_RETRY_AFTER = float(os.environ.get('RATE_LIMIT_MAX_RETRY_AFTER', '60'))
+# Decreases closer together than this are caused by the same burst
+DECREASE_INTERVAL = 1.0
+THROTTLED = 429
+# Returned by ``try_acquire`` when only a released slot lets the call through
+UNTIL_RELEASE = float('inf')
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def retry_after_seconds(value):
+    """Parse a Retry-After header given in seconds or as an HTTP date"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class Limiter:
+    """Admission control for the calls sharing one upstream host and credential"""
+
+    def __init__(self, rate=RATE, burst=BURST, concurrency=INITIAL_CONCURRENCY,
+                 min_concurrency=MIN_CONCURRENCY, max_concurrency=MAX_CONCURRENCY, latency_target=LATENCY_TARGET):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_target = latency_target
+        self.limit = min(max(concurrency, min_concurrency), max_concurrency)
+        self.in_flight = 0
+        self.tokens = float(self.burst)
+        self.blocked_until = 0.0
+        self.throttled = 0
+        self.decreases = 0
+        self._refilled = time.monotonic()
+        self._decreased = 0.0
+        self._condition = threading.Condition()
+        # (loop, future) of coroutines in ``acquire_async`` waiting for a slot
+        self._waiters = deque()
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def try_acquire(self):
+        """Take a slot if one is free; otherwise return the seconds to wait before trying again.
+
+        ``UNTIL_RELEASE`` means every slot is taken and the next ``release`` is
+        the earliest chance.
+        """
+        with self._condition:
+            return self._try_acquire_locked()
+
+    def _try_acquire_locked(self):
+        now = time.monotonic()
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        if self.in_flight >= int(self.limit):
+            return UNTIL_RELEASE
+        if self.rate > 0:
+            self._refill(now)
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        self.in_flight += 1
+        return 0.0
+
+    def acquire(self):
+        """Block until the call may be sent"""
+        # Checking and waiting under one lock, so no release can slip in between
+        with self._condition:
+            while True:
+                wait = self._try_acquire_locked()
+                if not wait:
+                    return
+                self._condition.wait(None if wait == UNTIL_RELEASE else wait)
+
+    async def acquire_async(self):
+        """Wait until the call may be sent without blocking the event loop.
+
+        Coroutines waiting for a slot are woken by ``release``, one per free
+        slot; timed waits (Retry-After, token refill) sleep exactly that long.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                wait = self._try_acquire_locked()
+                if not wait:
+                    return
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            try:
+                await asyncio.wait_for(waiter, None if wait == UNTIL_RELEASE else wait)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._condition:
+                    try:
+                        self._waiters.remove((loop, waiter))
+                    except ValueError:
+                        # Already woken; pass the wakeup on if this coroutine will not use it
+                        if not waiter.done() or waiter.cancelled():
+                            self._wake()
+
+    def release(self, status=None, latency=None, retry_after=None):
+        """Record the outcome of a call admitted by ``acquire``.
+
+        ``status`` is None when the call failed without an answer; such calls
+        neither grow nor shrink the limit.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if status == THROTTLED:
+                self.throttled += 1
+                pause = retry_after_seconds(retry_after)
+                pause = DEFAULT_RETRY_AFTER if pause is None else min(pause, MAX_RETRY_AFTER)
+                self.blocked_until = max(self.blocked_until, now + pause)
+                self._decrease(now, 0.5)
+            elif status is not None and latency is not None and latency > self.latency_target:
+                self._decrease(now, 0.9)
+            elif status is not None and status < 500:
+                self.limit = min(self.limit + 1 / self.limit, self.max_concurrency)
+            self._condition.notify_all()
+            self._wake()
+
+    def _wake(self):
+        """Wake as many async waiters as there are free slots, at least one; call with the lock held"""
+        free = max(int(self.limit) - self.in_flight, 1)
+        while self._waiters and free:
+            loop, waiter = self._waiters.popleft()
+            loop.call_soon_threadsafe(_resolve, waiter)
+            free -= 1
+
+    def _decrease(self, now, factor):
+        if now - self._decreased < DECREASE_INTERVAL:
+            return
+        self._decreased = now
+        self.decreases += 1
+        self.limit = max(self.limit * factor, self.min_concurrency)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'concurrency_limit': self.limit,
+                'in_flight': self.in_flight,
+                'throttled': self.throttled,
+                'decreases': self.decreases,
+                'blocked_seconds': max(self.blocked_until - time.monotonic(), 0.0),
+            }
+
+
+def _resolve(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def get_limiter(host, credential, asynchronous=False):
+    """Return the limiter shared by every call to ``host`` with ``credential``.
+
+    The aiohttp backend gets limiters of its own, bounded by the
+    ``RATE_LIMIT_ASYNC_*`` concurrency settings.
+    """
+    key = (host, credential, asynchronous)
+    limiter = _limiters.get(key)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(key)
+            if limiter is None:
+                if asynchronous:
+                    limiter = Limiter(concurrency=ASYNC_INITIAL_CONCURRENCY, max_concurrency=ASYNC_MAX_CONCURRENCY)
+                else:
+                    limiter = Limiter()
+                _limiters[key] = limiter
+    return limiter
+
+
+@metrics.register_stats
+def _limiter_stats():
+    with _limiters_lock:
+        limiters = list(_limiters.items())
+    for (host, credential, asynchronous), limiter in limiters:
+        # A prefix of the credential digest tells callers apart without exposing anything
+        labels = {'host': host, 'credential': credential[:8], 'backend': 'async' if asynchronous else 'sync'}
+        for name, value in limiter.stats().items():
+            yield f'bitbucket_upstream_limiter_{name}', f'Upstream limiter {name.replace("_", " ")}', labels, value
@@ -1,11 +1,16 @@
+import os
+
 import requests
 from flask import Flask
-from flask_restplus import Api, Resource, reqparse
-import subprocess
-import os
+from flask_restx import Api, Resource, inputs, reqparse
+
+import metrics
+import upstream
+from jobs import get_runner
+from migration import Migration
 
-app = Flask(__name__)
-api = Api(app)
+# Resources are registered on ``api`` at import; the Flask app is built by create_app
+api = Api()
 
 # Request parsers
 create_project_parser = reqparse.RequestParser()
@@ -13,109 +18,127 @@ create_project_parser.add_argument('bitbucket_cloud_workspace', type=str, requir
 create_project_parser.add_argument('bitbucket_cloud_username', type=str, required=True, help='Bitbucket Cloud username')
 create_project_parser.add_argument('bitbucket_cloud_password', type=str, required=True, help='Bitbucket Cloud password')
 create_project_parser.add_argument('bitbucket_cloud_url', type=str, required=True, help='Bitbucket Cloud API URL')
+create_project_parser.add_argument('git_workers', type=inputs.positive, required=False, help='Number of parallel git transfers')
+create_project_parser.add_argument('api_workers', type=inputs.positive, required=False, help='Number of parallel Bitbucket Cloud API calls')
+create_project_parser.add_argument('incremental', type=inputs.boolean, default=False, help='Keep mirrors between runs and push only changed repositories')
+create_project_parser.add_argument('streaming', type=inputs.boolean, default=False, help='Use temporary bare clones that are deleted after the push')
+create_project_parser.add_argument('disk_budget', type=int, required=False, help='Scratch disk in bytes shared by streaming transfers')
 
 parser = reqparse.RequestParser()
 parser.add_argument('BITBUCKET_URL', type=str, required=True)
 parser.add_argument('BITBUCKET_TOKEN', type=str, required=True)
 
+credentials_parser = reqparse.RequestParser()
+credentials_parser.add_argument('bitbucket_cloud_password', type=str, required=True, help='Bitbucket Cloud password')
+credentials_parser.add_argument('BITBUCKET_TOKEN', type=str, required=True)
+
 @api.route('/create')
 class BitbucketCloudMirror(Resource):
     @api.expect(create_project_parser, parser)
     def post(self):
-        """move projects, repositories, and files from a source Bitbucket to Bitbucket Cloud"""
+        """Start moving projects, repositories, and files from a source Bitbucket to Bitbucket Cloud"""
 
         args = create_project_parser.parse_args()
         parser_args = parser.parse_args()
         args.update(parser_args)
-        workspace = args['bitbucket_cloud_workspace']
-        username = args['bitbucket_cloud_username']
-        password = args['bitbucket_cloud_password']
-        bitbucket_url = args['bitbucket_cloud_url']
-        BITBUCKET_URL = args['BITBUCKET_URL']
-        BITBUCKET_TOKEN = args['BITBUCKET_TOKEN']
-
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {BITBUCKET_TOKEN}'
+        settings = {
+            'source_url': args['BITBUCKET_URL'],
+            'cloud_url': args['bitbucket_cloud_url'],
+            'workspace': args['bitbucket_cloud_workspace'],
+            'username': args['bitbucket_cloud_username'],
+            'git_workers': args['git_workers'],
+            'api_workers': args['api_workers'],
+            'incremental': args['incremental'],
+            'streaming': args['streaming'],
+            'disk_budget': args['disk_budget'],
         }
+        job_id = get_runner().submit(settings, args['BITBUCKET_TOKEN'], args['bitbucket_cloud_password'])
+        return {'message': 'Migration started', 'job_id': job_id}, 202, {'Location': f'/jobs/{job_id}'}
 
-        # Retrieve a list of projects from the source Bitbucket instance
-        response = requests.get(f'{BITBUCKET_URL}/rest/api/1.0/projects', headers=headers)
-        source_projects_data = response.json()
-
-        created_items = []
-
-        for project in source_projects_data['values']:
-            project_key = project['key']
-            project_name = project['name']
-            project_description = project.get('description', '')  # Use an empty string if description is not provided
-
-            auth = (username, password)
-
-            # Check if the project exists in Bitbucket Cloud
-            project_exists_url = f"{bitbucket_url}/workspaces/{workspace}/projects/{project_key}"
-            response = requests.get(project_exists_url, auth=auth)
-
-            if response.status_code != 200:
-                # Project doesn't exist, so create it
-                project_create_url = f"{bitbucket_url}/workspaces/{workspace}/projects/"
-                new_project_data = {
-                    "name": project_name,
-                    "key": project_key,
-                    "description": project_description
-                }
-
-                response = requests.post(project_create_url, json=new_project_data, auth=auth)
-
-                if response.status_code == 201:
-                    created_items.append(f"Project: {project_name}")
-
-            # Retrieve repositories from the source project
-            source_repositories_url = f'{BITBUCKET_URL}/rest/api/1.0/projects/{project_key}/repos'
-            response = requests.get(source_repositories_url, headers=headers)
-            source_repositories_data = response.json()
-
-            for repository in source_repositories_data['values']:
-                repository_name = repository['name']
-                repository_description = repository.get('description', '')
-                public = repository['public']
-
-                # Create a repository in Bitbucket Cloud (create the repository every time)
-                repository_create_url = f"{bitbucket_url}/repositories/{workspace}/{repository_name}"
-                new_repository_data = {
-                    "scm": "git",
-                    "project": {
-                        "key": project_key
-                    },
-                    "is_private": not public,  # Invert the 'public' flag to set private repositories
-                    "description": repository_description
-                }
-
-                response = requests.post(repository_create_url, json=new_repository_data, auth=auth)
-
-                if response.status_code == 201:
-                    created_items.append(f"Repository: {repository_name}")
-                repo_name = repository_name
-                local_repo_path = f'./{project_name}/{repo_name}'
-                if not os.path.exists(local_repo_path):
-                    os.makedirs(local_repo_path)
-
-                # Clone the repository from the source Bitbucket instance
-                clone_url = f'{BITBUCKET_URL}/scm/{project_key}/{repository_name}.git'
-                print(clone_url)
-                subprocess.run(['git', 'clone', clone_url, local_repo_path])
-                # Push to Bitbucket Cloud using the git mirror command
-                cloud_remote_url = f'https://Ambarishg1@bitbucket.org/{workspace}/{repository_name}.git'
-                subprocess.run(['git', 'remote', 'add', 'cloud', cloud_remote_url], cwd=local_repo_path)
-                print(cloud_remote_url)
-                # Fetch and push the repository to Bitbucket Cloud
-                subprocess.run(['git', 'fetch', '--all'], cwd=local_repo_path)
-                subprocess.run(['git', 'push', '--mirror', 'cloud'], cwd=local_repo_path)
-
-        if created_items:
-            return {'message': 'New Bitbucket Cloud projects, repositories, and files moved successfully', 'created_items': created_items}, 201
-        else:
-            return {'message': 'No projects, repositories, or files were moved to Bitbucket Cloud'}, 204
+@api.route('/plan')
+class MigrationPlan(Resource):
+    @api.expect(create_project_parser, parser)
+    def post(self):
+        """Dry run: diff the source inventory against Bitbucket Cloud without changing anything"""
+        args = create_project_parser.parse_args()
+        args.update(parser.parse_args())
+        migration = Migration(source_url=args['BITBUCKET_URL'],
+                              source_token=args['BITBUCKET_TOKEN'],
+                              cloud_url=args['bitbucket_cloud_url'],
+                              workspace=args['bitbucket_cloud_workspace'],
+                              username=args['bitbucket_cloud_username'],
+                              password=args['bitbucket_cloud_password'],
+                              api_workers=args['api_workers'])
+        try:
+            plan = migration.plan()
+        except (upstream.UpstreamError, requests.exceptions.RequestException) as e:
+            return {"error": f"Request failed: {str(e)}"}, 500
+        return plan.summary(), 200
+
+@api.route('/jobs')
+class MigrationJobList(Resource):
+    def get(self):
+        """List migration jobs, newest first"""
+        return get_runner().store.list(), 200
+
+@api.route('/jobs/<job_id>')
+class MigrationJob(Resource):
+    def get(self, job_id):
+        """Progress of a migration job"""
+        job = get_runner().store.get(job_id)
+        if job is None:
+            return {"error": f"Job {job_id} not found"}, 404
+        return job, 200
+
+    def delete(self, job_id):
+        """Cancel a migration job; repositories already transferring are finished"""
+        runner = get_runner()
+        if runner.store.row(job_id) is None:
+            return {"error": f"Job {job_id} not found"}, 404
+        if not runner.cancel(job_id):
+            return {"error": f"Job {job_id} is not running"}, 409
+        return runner.store.get(job_id), 202
+
+@api.route('/jobs/<job_id>/repositories')
+class MigrationJobRepositories(Resource):
+    def get(self, job_id):
+        """Per-repository results of a migration job"""
+        store = get_runner().store
+        if store.row(job_id) is None:
+            return {"error": f"Job {job_id} not found"}, 404
+        return store.repositories(job_id), 200
+
+@api.route('/jobs/<job_id>/resume')
+class MigrationJobResume(Resource):
+    @api.expect(credentials_parser)
+    def post(self, job_id):
+        """Resume an interrupted, failed or cancelled job, skipping repositories already migrated"""
+        args = credentials_parser.parse_args()
+        runner = get_runner()
+        if runner.store.row(job_id) is None:
+            return {"error": f"Job {job_id} not found"}, 404
+        if not runner.resume(job_id, args['BITBUCKET_TOKEN'], args['bitbucket_cloud_password']):
+            return {"error": f"Job {job_id} is still running"}, 409
+        return {'message': 'Migration resumed', 'job_id': job_id}, 202, {'Location': f'/jobs/{job_id}'}
+
+def create_app():
+    """Build the migration service app"""
+    app = Flask(__name__)
+    api.init_app(app)
+    metrics.init_app(app)
+    return app
+
+_app = None
+
+def __getattr__(name):
+    # ``repo.app`` is built on first use, so importing the module stays cheap
+    global _app
+    if name != 'app':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    if _app is None:
+        _app = create_app()
+    return _app
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # Development server only; production runs under gunicorn (see gunicorn.conf.py)
+    create_app().run(debug=os.environ.get('FLASK_DEBUG') == '1')
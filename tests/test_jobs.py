@@ -0,0 +1,93 @@
+import time
+
+import pytest
+
+from benchmarks.mock_bitbucket import CLOUD_PREFIX, MockBitbucket, State
+from benchmarks.run import git
+import jobs
+from jobs import JobRunner, JobStore
+from migration import SUCCESS
+
+
+@pytest.fixture
+def mock():
+    server = MockBitbucket(state=State(projects=1, repositories=2, users=1)).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / 'jobs.sqlite3'))
+
+
+def wait(store, job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = store.get(job_id)
+        if job['status'] not in ('queued', 'running'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f'job {job_id} did not finish')
+
+
+def test_migrated_counts_every_success_status(store):
+    job_id = store.create({})
+    for n, status in enumerate(SUCCESS + ('failed',)):
+        store.record_result(job_id, {'project': 'PRJ0', 'repository': f'repo-{n}', 'status': status})
+    assert store.migrated(job_id) == {('PRJ0', f'repo-{n}') for n in range(len(SUCCESS))}
+
+
+def test_resume_skips_migrated_repositories(mock, store, tmp_path, monkeypatch):
+    root = tmp_path / 'git'
+    seed = root / 'seed'
+    git('init', '-q', str(seed))
+    (seed / 'file.txt').write_text('content\n')
+    git('add', 'file.txt', cwd=seed)
+    git('-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-q', '-m', 'initial', cwd=seed)
+    for slug in mock.state.repositories['PRJ0']:
+        git('clone', '-q', '--bare', str(seed), str(root / 'source' / f'{slug}.git'))
+    # Only the first repository can be pushed; the push of the second one fails
+    git('init', '-q', '--bare', str(root / 'cloud' / 'prj0-repo-0.git'))
+
+    cloned = []
+
+    def clone_url(self, project, repository):
+        cloned.append(repository['slug'])
+        return str(root / 'source' / f'{repository["slug"]}.git')
+
+    monkeypatch.setattr(jobs.JobMigration, 'clone_url', clone_url)
+    monkeypatch.setattr(jobs.JobMigration, 'cloud_remote_url',
+                        lambda self, repository: str(root / 'cloud' / f'{repository["slug"]}.git'))
+
+    runner = JobRunner(store)
+    settings = {'source_url': mock.url, 'cloud_url': mock.url + CLOUD_PREFIX,
+                'workspace': 'workspace', 'username': 'user', 'workdir': str(tmp_path / 'work')}
+    job_id = runner.submit(settings, 'token', 'password')
+    job = wait(store, job_id)
+    assert job['status'] == 'failed'
+    assert job['repositories'] == {'total': 2, 'done': 1, 'failed': 1}
+    assert {row['repository']: row['status'] for row in store.repositories(job_id)} == {
+        'prj0-repo-0': 'migrated', 'prj0-repo-1': 'failed'}
+
+    git('init', '-q', '--bare', str(root / 'cloud' / 'prj0-repo-1.git'))
+    cloned.clear()
+    assert runner.resume(job_id, 'token', 'password')
+    job = wait(store, job_id)
+    assert job['status'] == 'completed'
+    assert job['error'] is None
+    assert job['repositories'] == {'total': 2, 'done': 2, 'failed': 0}
+    # The repository migrated by the first run is not touched again
+    assert set(cloned) == {'prj0-repo-1'}
+    assert {row['repository']: row['status'] for row in store.repositories(job_id)} == {
+        'prj0-repo-0': 'migrated', 'prj0-repo-1': 'migrated'}
+
+
+def test_recover_uses_the_heartbeat(store):
+    stale, fresh = store.create({}), store.create({})
+    # Both are owned by this very process, as after a restart that reuses the hostname and PID
+    store.update(stale, status='running', heartbeat_at=time.time() - 2 * jobs.HEARTBEAT_TIMEOUT)
+    store.update(fresh, status='running', heartbeat_at=time.time())
+    store.recover()
+    assert store.get(stale)['status'] == 'interrupted'
+    assert store.get(fresh)['status'] == 'running'
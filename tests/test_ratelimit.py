@@ -0,0 +1,62 @@
+import asyncio
+import threading
+
+import ratelimit
+from ratelimit import Limiter
+
+
+def test_acquire_release_from_many_threads():
+    limiter = Limiter(concurrency=1, max_concurrency=2)
+    peak = 0
+    lock = threading.Lock()
+
+    def work():
+        nonlocal peak
+        for _ in range(200):
+            limiter.acquire()
+            with lock:
+                peak = max(peak, limiter.stats()['in_flight'])
+            limiter.release(200, 0.0)
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    # A lost wakeup leaves a thread blocked with nothing in flight
+    assert not any(thread.is_alive() for thread in threads)
+    assert limiter.stats()['in_flight'] == 0
+    assert peak <= 2
+
+
+def test_release_wakes_blocked_acquire():
+    limiter = Limiter(concurrency=1, max_concurrency=1)
+    limiter.acquire()
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()), daemon=True)
+    thread.start()
+    assert not acquired.wait(0.1)
+    limiter.release(200, 0.0)
+    assert acquired.wait(5)
+
+
+def test_acquire_async_waits_for_release():
+    limiter = Limiter(concurrency=1, max_concurrency=1)
+
+    async def run():
+        await limiter.acquire_async()
+        waiting = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        limiter.release(200, 0.0)
+        await asyncio.wait_for(waiting, 5)
+
+    asyncio.run(run())
+    assert limiter.stats()['in_flight'] == 1
+
+
+def test_retry_after_is_capped():
+    limiter = Limiter()
+    limiter.acquire()
+    limiter.release(ratelimit.THROTTLED, 0.0, '86400')
+    assert 0 < limiter.stats()['blocked_seconds'] <= ratelimit.MAX_RETRY_AFTER
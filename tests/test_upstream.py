@@ -0,0 +1,31 @@
+import threading
+
+import upstream
+
+
+def test_fanout_workers_is_capped(monkeypatch):
+    monkeypatch.setattr(upstream, 'FANOUT_MAX_WORKERS', 4)
+    assert upstream.fanout_workers(None) == min(upstream.FANOUT_WORKERS, 4)
+    assert upstream.fanout_workers(2) == 2
+    assert upstream.fanout_workers(10000) == 4
+
+
+def test_fan_out_runs_at_most_the_capped_workers(monkeypatch):
+    monkeypatch.setattr(upstream, 'FANOUT_MAX_WORKERS', 3)
+    running = peak = 0
+    lock = threading.Lock()
+    release = threading.Event()
+
+    def work(item):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        release.wait(0.05)
+        with lock:
+            running -= 1
+        return item
+
+    results = upstream.fan_out(work, range(20), max_workers=1000, deadline=0)
+    assert results == [(item, None) for item in range(20)]
+    assert peak <= 3
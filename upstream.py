@@ -0,0 +1,310 @@
+"""Shared, pooled HTTP client used for every call to an upstream Bitbucket."""
+import contextvars
+import hashlib
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+import ratelimit
+
+POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', '20'))
+POOL_BLOCK = os.environ.get('UPSTREAM_POOL_BLOCK', 'false').lower() == 'true'
+CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', '30'))
+MAX_RETRIES = int(os.environ.get('UPSTREAM_MAX_RETRIES', '3'))
+BACKOFF_FACTOR = float(os.environ.get('UPSTREAM_BACKOFF_FACTOR', '0.5'))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+FANOUT_WORKERS = int(os.environ.get('FANOUT_WORKERS', '8'))
+# Upper bound for a caller's ``max_workers``; each worker is a thread
+FANOUT_MAX_WORKERS = int(os.environ.get('FANOUT_MAX_WORKERS', '32'))
+FANOUT_DEADLINE = float(os.environ.get('FANOUT_DEADLINE', '60'))
+# Upstream URLs to open connections to when a worker starts, comma separated
+WARM_URLS = [url.strip() for url in os.environ.get('UPSTREAM_WARM_URLS', '').split(',') if url.strip()]
+WARM_CONNECTIONS = int(os.environ.get('UPSTREAM_WARM_CONNECTIONS', '4'))
+COALESCE = os.environ.get('UPSTREAM_COALESCE', 'true').lower() == 'true'
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+class UpstreamError(Exception):
+    """An upstream call answered with an unexpected status code"""
+
+    def __init__(self, status_code, message=None):
+        super().__init__(message or f'Request failed with status code: {status_code}')
+        self.status_code = status_code
+
+
+class DeadlineExceeded(TimeoutError):
+    """A fan-out call was still pending at the deadline; ``started`` tells whether it may still run"""
+
+    def __init__(self, started):
+        super().__init__('Deadline exceeded')
+        self.started = started
+
+
+def base_url(url):
+    """Return the scheme://host[:port] part of a URL, used as the pool key"""
+    parts = urlsplit(url)
+    return f'{parts.scheme}://{parts.netloc}'.lower()
+
+
+def credential_id(headers=None, auth=None):
+    """Return a digest identifying the caller's credentials without storing them"""
+    digest = hashlib.sha256()
+    digest.update(((headers or {}).get('Authorization') or '').encode())
+    if auth:
+        digest.update(b'\0' + ':'.join(str(part) for part in auth).encode())
+    return digest.hexdigest()
+
+
+def _new_session():
+    # 429s are retried by ``request`` so that the rate limiter sees them and
+    # their Retry-After; urllib3 would otherwise retry them on its own.
+    retry = Retry(total=MAX_RETRIES,
+                  backoff_factor=BACKOFF_FACTOR,
+                  status_forcelist=[status for status in RETRY_STATUSES if status != ratelimit.THROTTLED],
+                  respect_retry_after_header=False,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=POOL_SIZE,
+                          pool_block=POOL_BLOCK,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # The session is shared between callers with different credentials and
+    # between threads, so never persist cookies from upstream responses.
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+def get_session(url):
+    """Return the keep-alive session for the host of ``url``, creating it once"""
+    key = base_url(url)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _sessions[key] = _new_session()
+    return session
+
+
+def request(method, url, **kwargs):
+    """Send a request through the pooled session for the upstream host.
+
+    Calls are admitted by the rate limiter of the host and credential; a 429
+    pauses that limiter for the Retry-After period and the call is retried up
+    to ``MAX_RETRIES`` times.
+    """
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    host = base_url(url)
+    limiter = ratelimit.get_limiter(host, credential_id(kwargs.get('headers'), kwargs.get('auth')))
+    attempt = 0
+    while True:
+        limiter.acquire()
+        started = time.perf_counter()
+        try:
+            with metrics.upstream_call(host, method) as call:
+                response = get_session(url).request(method, url, **kwargs)
+                call.status = response.status_code
+        except Exception:
+            limiter.release()
+            raise
+        limiter.release(response.status_code, time.perf_counter() - started, response.headers.get('Retry-After'))
+        if response.status_code != ratelimit.THROTTLED or attempt >= MAX_RETRIES:
+            return response
+        response.close()
+        attempt += 1
+
+
+def request_key(url, params=None, headers=None, auth=None):
+    """Identify a GET by URL, query, headers and credentials, for coalescing"""
+    if isinstance(params, dict):
+        params = sorted((name, str(value)) for name, value in params.items())
+    other_headers = sorted((name.lower(), str(value)) for name, value in (headers or {}).items()
+                           if name.lower() != 'authorization')
+    return url, tuple(params or ()), tuple(other_headers), credential_id(headers, auth)
+
+
+class _Flight:
+    __slots__ = ('done', 'response', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+def get(url, **kwargs):
+    """GET ``url``; identical GETs issued while one is in flight share its response"""
+    if not COALESCE or kwargs.get('stream'):
+        return request('GET', url, **kwargs)
+    key = request_key(url, kwargs.get('params'), kwargs.get('headers'), kwargs.get('auth'))
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+    if not leader:
+        metrics.UPSTREAM_COALESCED.labels(base_url(url)).inc()
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.response
+    try:
+        flight.response = request('GET', url, **kwargs)
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+    return flight.response
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
+
+
+def iter_pages(url, params=None, fetch=None, **kwargs):
+    """Yield every page of a paged Bitbucket Server collection.
+
+    Follows ``nextPageStart`` until ``isLastPage`` is set, so only one page is
+    held in memory at a time. ``fetch`` replaces ``get`` for issuing the
+    requests, e.g. to read through a cache.
+    """
+    fetch = fetch or get
+    params = dict(params or {})
+    while True:
+        response = fetch(url, params=params, **kwargs)
+        if response.status_code != 200:
+            raise UpstreamError(response.status_code)
+        page = response.json()
+        yield page
+        if page.get('isLastPage', True) or page.get('nextPageStart') is None:
+            return
+        params['start'] = page['nextPageStart']
+
+
+def iter_values(url, params=None, **kwargs):
+    """Yield the ``values`` of every page of a paged collection"""
+    for page in iter_pages(url, params=params, **kwargs):
+        yield from page.get('values', [])
+
+
+def iter_cloud_values(url, params=None, **kwargs):
+    """Yield the ``values`` of every page of a paged Bitbucket Cloud collection.
+
+    Cloud pages link to each other with an absolute ``next`` URL.
+    """
+    response = get(url, params=params, **kwargs)
+    while True:
+        if response.status_code != 200:
+            raise UpstreamError(response.status_code)
+        page = response.json()
+        yield from page.get('values', [])
+        if not page.get('next'):
+            return
+        response = get(page['next'], **kwargs)
+
+
+def close_all():
+    """Close every pooled session, e.g. when a worker process shuts down"""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def warm(urls=None, connections=None):
+    """Open keep-alive connections to upstream hosts before the first request needs them.
+
+    Sends concurrent HEAD requests so that several connections per host end up
+    in the pool. Returns ``(status_code, error)`` pairs; failures are harmless.
+    """
+    urls = WARM_URLS if urls is None else urls
+    connections = min(connections or WARM_CONNECTIONS, POOL_SIZE)
+    calls = [url for url in urls for _ in range(connections)]
+    return fan_out(lambda url: request('HEAD', url, allow_redirects=False).status_code,
+                   calls, max_workers=len(calls))
+
+
+@metrics.register_stats
+def _pool_stats():
+    with _sessions_lock:
+        sessions = list(_sessions.items())
+    for host, session in sessions:
+        pools = session.get_adapter(host).poolmanager.pools
+        opened = requests_sent = idle = 0
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:
+                continue
+            opened += pool.num_connections
+            requests_sent += pool.num_requests
+            if pool.pool is not None:
+                # The queue is pre-filled with None placeholders for connections not opened yet
+                idle += sum(1 for connection in list(pool.pool.queue) if connection is not None)
+        labels = {'host': host}
+        yield 'bitbucket_upstream_pool_connections_opened', 'Connections opened to an upstream host', labels, opened
+        yield 'bitbucket_upstream_pool_requests', 'Requests sent over pooled connections', labels, requests_sent
+        yield 'bitbucket_upstream_pool_idle_connections', 'Idle keep-alive connections', labels, idle
+        yield 'bitbucket_upstream_pool_size', 'Configured connections per upstream host', labels, POOL_SIZE
+
+
+def fanout_workers(max_workers=None):
+    """Workers for one fan-out: ``max_workers`` or the default, at most ``FANOUT_MAX_WORKERS``"""
+    return max(1, min(max_workers or FANOUT_WORKERS, FANOUT_MAX_WORKERS))
+
+
+def fan_out(func, items, max_workers=None, deadline=None):
+    """Call ``func(item)`` for every item on a bounded thread pool.
+
+    Returns ``(result, error)`` pairs in the same order as ``items``. Calls
+    still pending when ``deadline`` seconds have passed are reported with a
+    ``DeadlineExceeded``: those not started yet are cancelled, running ones
+    are abandoned but finish in the background. A ``deadline`` of 0 waits
+    for all.
+    """
+    items = list(items)
+    if not items:
+        return []
+    max_workers = fanout_workers(max_workers)
+    deadline = FANOUT_DEADLINE if deadline is None else deadline
+    results = [(None, None)] * len(items)
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items))))
+    try:
+        # Each call runs in a copy of the caller's context so per-request timings follow it
+        futures = {executor.submit(contextvars.copy_context().run, func, item): index
+                   for index, item in enumerate(items)}
+        done, not_done = wait(futures, timeout=deadline or None)
+        for future in not_done:
+            results[futures[future]] = (None, DeadlineExceeded(started=not future.cancel()))
+        for future in done:
+            error = future.exception()
+            results[futures[future]] = (None, error) if error else (future.result(), None)
+    finally:
+        executor.shutdown(wait=False)
+    return results